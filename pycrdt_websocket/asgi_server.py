@@ -3,6 +3,8 @@ from __future__ import annotations
 from inspect import isawaitable
 from typing import Any, Awaitable, Callable
 
+from .compression import COMPRESSION_SUBPROTOCOL, CompressedWebsocket
+from .websocket import Websocket
 from .websocket_server import WebsocketServer
 
 
@@ -29,14 +31,19 @@ class ASGIWebsocket:
     async def __anext__(self) -> bytes:
         return await self.recv()
 
-    async def send(self, message: bytes) -> None:
-        await self._send(
-            dict(
-                type="websocket.send",
-                bytes=message,
-            )
+    @classmethod
+    def prepare_message(cls, message: bytes) -> dict[str, Any]:
+        return dict(
+            type="websocket.send",
+            bytes=message,
         )
 
+    async def send(self, message: bytes) -> None:
+        await self.send_prepared(self.prepare_message(message))
+
+    async def send_prepared(self, frame: dict[str, Any]) -> None:
+        await self._send(frame)
+
     async def recv(self) -> bytes:
         message = await self._receive()
         if message["type"] == "websocket.receive":
@@ -59,6 +66,7 @@ class ASGIServer:
         on_connect: Callable[[dict[str, Any], dict[str, Any]], Awaitable[bool] | bool]
         | None = None,
         on_disconnect: Callable[[dict[str, Any]], Awaitable[None] | None] | None = None,
+        compression: type[CompressedWebsocket] | None = None,
     ):
         """Initialize the object.
 
@@ -67,10 +75,16 @@ class ASGIServer:
             on_connect: An optional callback to call when connecting the WebSocket.
                 If the callback returns True, the WebSocket is not accepted.
             on_disconnect: An optional callback called when disconnecting the WebSocket.
+            compression: An optional CompressedWebsocket class (or subclass), with which
+                to compress the messages of the clients requesting the
+                `COMPRESSION_SUBPROTOCOL` subprotocol. Other clients are served as usual.
+                Note that the permessage-deflate WebSocket extension, if enabled, is
+                negotiated by the ASGI server itself (e.g. Uvicorn or Hypercorn).
         """
         self._websocket_server = websocket_server
         self._on_connect = on_connect
         self._on_disconnect = on_disconnect
+        self._compression = compression
 
     async def __call__(
         self,
@@ -87,6 +101,12 @@ class ASGIServer:
                 if close:
                     return
 
-            await send({"type": "websocket.accept"})
-            websocket = ASGIWebsocket(receive, send, scope["path"], self._on_disconnect)
+            websocket: Websocket = ASGIWebsocket(receive, send, scope["path"], self._on_disconnect)
+            if self._compression is not None and COMPRESSION_SUBPROTOCOL in scope.get(
+                "subprotocols", ()
+            ):
+                await send({"type": "websocket.accept", "subprotocol": COMPRESSION_SUBPROTOCOL})
+                websocket = self._compression(websocket)
+            else:
+                await send({"type": "websocket.accept"})
             await self._websocket_server.serve(websocket)
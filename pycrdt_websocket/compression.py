@@ -0,0 +1,90 @@
+from __future__ import annotations
+
+import zlib
+from typing import Any
+
+from .websocket import Websocket
+
+# the WebSocket subprotocol negotiating the compression envelope
+COMPRESSION_SUBPROTOCOL = "y-zlib"
+
+# the first byte of each message in the envelope
+_RAW = b"\x00"
+_ZLIB = b"\x01"
+
+
+class CompressedWebsocket:
+    """A WebSocket compressing the messages above a size threshold, e.g. the SYNC_STEP2
+    message sent to a client joining a large document.
+
+    Each message is sent in an envelope: a first byte telling whether the rest of the message
+    is compressed with zlib, so that both sides must use a CompressedWebsocket. Whether they do
+    is negotiated with the `COMPRESSION_SUBPROTOCOL` WebSocket subprotocol, see the
+    `compression` argument of `ASGIServer` for the server side. On the client side:
+    ```py
+    async with aconnect_ws(url, subprotocols=[COMPRESSION_SUBPROTOCOL]) as websocket:
+        ywebsocket = HttpxWebsocket(websocket, room_name)
+        if websocket.subprotocol == COMPRESSION_SUBPROTOCOL:
+            ywebsocket = CompressedWebsocket(ywebsocket)
+        async with WebsocketProvider(ydoc, ywebsocket):
+            ...
+    ```
+    When a room sends the same message to many clients, the message is compressed only once.
+    The threshold and compression level can be changed by subclassing.
+    """
+
+    # The size (in bytes) from which messages are compressed.
+    threshold: int = 1024
+    # The zlib compression level, from 1 (fastest) to 9 (smallest).
+    level: int = 6
+    # The maximum size (in bytes) of a decompressed message, above which it is rejected.
+    max_message_size: int = 256 * 1024 * 1024
+
+    def __init__(self, websocket: Websocket) -> None:
+        """Initialize the object.
+
+        Arguments:
+            websocket: The WebSocket through which to send and receive the messages.
+        """
+        self._websocket = websocket
+
+    @property
+    def path(self) -> str:
+        return self._websocket.path
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> bytes:
+        try:
+            message = await self.recv()
+        except Exception:
+            raise StopAsyncIteration()
+        return message
+
+    @classmethod
+    def prepare_message(cls, message: bytes) -> bytes:
+        if len(message) < cls.threshold:
+            return _RAW + message
+        return _ZLIB + zlib.compress(message, cls.level)
+
+    async def send(self, message: bytes) -> None:
+        await self.send_prepared(self.prepare_message(message))
+
+    async def send_prepared(self, frame: Any) -> None:
+        await self._websocket.send(frame)
+
+    async def recv(self) -> bytes:
+        message = await self._websocket.recv()
+        if not message:
+            return message
+        envelope, payload = message[:1], message[1:]
+        if envelope == _RAW:
+            return bytes(payload)
+        if envelope == _ZLIB:
+            decompressor = zlib.decompressobj()
+            message = decompressor.decompress(payload, self.max_message_size)
+            if decompressor.unconsumed_tail or not decompressor.eof:
+                raise RuntimeError("Invalid or too large compressed message")
+            return message
+        raise RuntimeError("Invalid compression envelope")
@@ -1,15 +1,21 @@
 from __future__ import annotations
 
+import asyncio
 from logging import getLogger
-from typing import TypedDict
+from typing import Any, TypedDict
 
+from channels.consumer import AsyncConsumer  # type: ignore[import-not-found,import-untyped]
 from channels.generic.websocket import AsyncWebsocketConsumer  # type: ignore[import-not-found]
 from pycrdt import (
     Doc,
+    Subscription,
+    TransactionEvent,
     YMessageType,
     YSyncMessageType,
     create_sync_message,
+    create_update_message,
     handle_sync_message,
+    merge_updates,
 )
 
 from .websocket import Websocket
@@ -81,6 +87,9 @@ class YjsConsumer(AsyncWebsocketConsumer):
       but be sure to call `await super().connect()` in the end.
     - Call `group_send_message` to send a message to an entire group/room.
     - Call `send_message` to send a message to a single client, although this is not recommended.
+    - Set `doc_worker_channel` to keep a single authoritative YDoc per room in a
+      [YjsDocWorker](#pycrdt_websocket.django_channels_consumer.YjsDocWorker), instead of
+      a replica of the YDoc in each consumer.
 
     A full example of a custom consumer showcasing all of these options is:
     ```py
@@ -126,6 +135,12 @@ class YjsConsumer(AsyncWebsocketConsumer):
 
     """
 
+    # The name of the channel of a YjsDocWorker holding the authoritative YDoc of each room.
+    # Document updates are then sent to the worker, which broadcasts them to the room in
+    # batches, and consumers don't keep a replica of the YDoc.
+    # Defaults to each consumer keeping its own replica of the YDoc (None).
+    doc_worker_channel: str | None = None
+
     def __init__(self):
         super().__init__()
         self.room_name = None
@@ -158,9 +173,18 @@ class YjsConsumer(AsyncWebsocketConsumer):
 
     async def connect(self) -> None:
         self.room_name = self.make_room_name()
-        self.ydoc = await self.make_ydoc()
         self._websocket_shim = self._make_websocket_shim(self.scope["path"])
+        if self.doc_worker_channel is not None:
+            await self.channel_layer.group_add(self.room_name, self.channel_name)
+            await self.accept()
+            # the worker sends the SYNC_STEP1 message of its YDoc
+            await self.channel_layer.send(
+                self.doc_worker_channel,
+                {"type": "yjs.connect", "room": self.room_name, "channel": self.channel_name},
+            )
+            return
 
+        self.ydoc = await self.make_ydoc()
         await self.channel_layer.group_add(self.room_name, self.channel_name)
         await self.accept()
 
@@ -174,10 +198,27 @@ class YjsConsumer(AsyncWebsocketConsumer):
 
     async def disconnect(self, code) -> None:
         await self.channel_layer.group_discard(self.room_name, self.channel_name)
+        if self.doc_worker_channel is not None:
+            await self.channel_layer.send(
+                self.doc_worker_channel,
+                {"type": "yjs.disconnect", "room": self.room_name, "channel": self.channel_name},
+            )
 
     async def receive(self, text_data=None, bytes_data=None):
         if bytes_data is None:
             return
+        if self.doc_worker_channel is not None and bytes_data[0] == YMessageType.SYNC:
+            # the worker replies to SYNC_STEP1 messages, and broadcasts the updates
+            await self.channel_layer.send(
+                self.doc_worker_channel,
+                {
+                    "type": "yjs.sync",
+                    "room": self.room_name,
+                    "channel": self.channel_name,
+                    "message": bytes_data,
+                },
+            )
+            return
         await self.group_send_message(bytes_data)
         if bytes_data[0] != YMessageType.SYNC:
             return
@@ -217,3 +258,136 @@ class YjsConsumer(AsyncWebsocketConsumer):
         await self.channel_layer.group_send(
             self.room_name, {"type": "send_message", "message": message}
         )
+
+
+class YjsDocWorker(AsyncConsumer):
+    """A [Django Channels](https://github.com/django/channels) worker holding the authoritative
+    YDoc of each room, for consumers with a `doc_worker_channel`.
+
+    Each update is applied once to the YDoc of its room, instead of once per consumer,
+    and the updates are broadcast to the room in batches, merged into a single update.
+    The worker is routed to the channel of the consumers:
+    ```py
+    # asgi.py
+    from channels.routing import ChannelNameRouter, ProtocolTypeRouter, URLRouter
+
+    application = ProtocolTypeRouter({
+        "websocket": URLRouter(urlpatterns_ws),
+        "channel": ChannelNameRouter({"yjs-doc-worker": YjsDocWorker.as_asgi()}),
+    })
+
+    # consumer.py
+    class DocConsumer(YjsConsumer):
+        doc_worker_channel = "yjs-doc-worker"
+    ```
+    and run with `python manage.py runworker yjs-doc-worker`. A single worker process must
+    run for a given channel, since it holds the YDocs in memory.
+
+    The worker can be subclassed to override `make_ydoc`, for instance to load the YDoc from
+    your database, and `release_ydoc`, for instance to save it when its room is empty.
+    """
+
+    # Determines the time (in seconds) during which updates are collected before being
+    # broadcast to their room, merged into a single update.
+    flush_delay: float = 0.05
+    ydocs: dict[str, Doc]
+    _channels: dict[str, set[str]]
+    _subscriptions: dict[str, Subscription]
+    _pending_updates: dict[str, list[bytes]]
+    _flush_tasks: dict[str, asyncio.Task]
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ydocs = {}
+        self._channels = {}
+        self._subscriptions = {}
+        self._pending_updates = {}
+        self._flush_tasks = {}
+
+    async def make_ydoc(self, room_name: str) -> Doc:
+        """Make the YDoc of a room, when its first client connects.
+
+        Arguments:
+            room_name: The name of the room.
+
+        Returns:
+            The YDoc of the room. Defaults to a new empty YDoc.
+        """
+        return Doc()
+
+    async def release_ydoc(self, room_name: str, ydoc: Doc) -> None:
+        """Release the YDoc of a room, when its last client disconnects.
+
+        Arguments:
+            room_name: The name of the room.
+            ydoc: The YDoc of the room.
+        """
+
+    async def yjs_connect(self, message: dict[str, Any]) -> None:
+        room_name = message["room"]
+        if room_name not in self.ydocs:
+            ydoc = self.ydocs[room_name] = await self.make_ydoc(room_name)
+            self._subscriptions[room_name] = ydoc.observe(
+                lambda event: self._put_update(room_name, event)
+            )
+        self._channels.setdefault(room_name, set()).add(message["channel"])
+        await self.channel_layer.send(
+            message["channel"],
+            {"type": "send_message", "message": create_sync_message(self.ydocs[room_name])},
+        )
+
+    async def yjs_disconnect(self, message: dict[str, Any]) -> None:
+        room_name = message["room"]
+        channels = self._channels.get(room_name, set())
+        channels.discard(message["channel"])
+        if channels or room_name not in self.ydocs:
+            return
+        del self._channels[room_name]
+        await self._flush(room_name)
+        ydoc = self.ydocs.pop(room_name)
+        ydoc.unobserve(self._subscriptions.pop(room_name))
+        await self.release_ydoc(room_name, ydoc)
+
+    async def yjs_sync(self, message: dict[str, Any]) -> None:
+        room_name = message["room"]
+        if message["channel"] not in self._channels.get(room_name, set()):
+            # the worker was restarted since the client connected: the YDoc is loaded again,
+            # and the client is sent its SYNC_STEP1 message to send back the missing updates
+            logger.warning(
+                "Received a message for room %s from a client that is not connected, "
+                "connecting it",
+                room_name,
+            )
+            await self.yjs_connect(message)
+        reply = handle_sync_message(message["message"][1:], self.ydocs[room_name])
+        if reply is not None:
+            await self.channel_layer.send(
+                message["channel"], {"type": "send_message", "message": reply}
+            )
+
+    def _put_update(self, room_name: str, event: TransactionEvent) -> None:
+        self._pending_updates.setdefault(room_name, []).append(event.update)
+        if room_name not in self._flush_tasks:
+            self._flush_tasks[room_name] = asyncio.create_task(self._flush_later(room_name))
+
+    async def _flush_later(self, room_name: str) -> None:
+        await asyncio.sleep(self.flush_delay)
+        try:
+            await self._flush(room_name)
+        except Exception as exception:
+            # nothing awaits this task, so its exceptions would be lost
+            logger.error(
+                "Error while broadcasting the updates of room %s", room_name, exc_info=exception
+            )
+
+    async def _flush(self, room_name: str) -> None:
+        task = self._flush_tasks.pop(room_name, None)
+        if task is not None and task is not asyncio.current_task():
+            task.cancel()
+        updates = self._pending_updates.pop(room_name, [])
+        if not updates:
+            return
+        update = updates[0] if len(updates) == 1 else merge_updates(*updates)
+        await self.channel_layer.group_send(
+            room_name, {"type": "send_message", "message": create_update_message(update)}
+        )
@@ -0,0 +1,312 @@
+from __future__ import annotations
+
+from contextlib import AsyncExitStack, asynccontextmanager
+from functools import partial
+from logging import Logger, getLogger
+from typing import Any, AsyncContextManager, AsyncIterator, Protocol
+from uuid import uuid4
+
+from anyio import (
+    TASK_STATUS_IGNORED,
+    Event,
+    Lock,
+    create_memory_object_stream,
+    create_task_group,
+)
+from anyio.abc import TaskGroup, TaskStatus
+from anyio.streams.memory import MemoryObjectReceiveStream, MemoryObjectSendStream
+from pycrdt import Decoder, Doc, Subscription, TransactionEvent, write_var_uint
+
+from .yroom import YRoom
+from .yutils import put_updates
+
+# the kinds of replication messages
+_UPDATE = b"\x00"
+_SYNC_STEP1 = b"\x01"
+_SYNC_STEP2 = b"\x02"
+
+
+class Bus(Protocol):
+    """A publish/subscribe message bus, through which rooms are replicated across nodes.
+    A message published on a channel is received by all the subscribers of the channel,
+    including the publisher if it is also a subscriber.
+    """
+
+    async def publish(self, channel: str, message: bytes) -> None:
+        """Publish a message on a channel.
+
+        Arguments:
+            channel: The channel on which to publish the message.
+            message: The message to publish.
+        """
+        ...
+
+    def subscribe(self, channel: str) -> AsyncContextManager[AsyncIterator[bytes]]:
+        """Subscribe to a channel.
+
+        Arguments:
+            channel: The channel to subscribe to.
+
+        Returns:
+            An async context manager entering an async iterator of the messages received
+            on the channel, until the context manager is exited.
+        """
+        ...
+
+
+class MemoryBus:
+    """A message bus for replicas in the same process, e.g. for testing."""
+
+    _subscribers: dict[str, set[MemoryObjectSendStream[bytes]]]
+
+    def __init__(self, max_buffer_size: int = 65536) -> None:
+        """Initialize the object.
+
+        Arguments:
+            max_buffer_size: The number of messages a subscriber can fall behind
+                before publishing waits for it.
+        """
+        self._max_buffer_size = max_buffer_size
+        self._subscribers = {}
+
+    async def publish(self, channel: str, message: bytes) -> None:
+        for send_stream in list(self._subscribers.get(channel, ())):
+            await send_stream.send(message)
+
+    @asynccontextmanager
+    async def subscribe(self, channel: str) -> AsyncIterator[AsyncIterator[bytes]]:
+        send_stream, receive_stream = create_memory_object_stream[bytes](
+            max_buffer_size=self._max_buffer_size
+        )
+        subscribers = self._subscribers.setdefault(channel, set())
+        subscribers.add(send_stream)
+        try:
+            async with receive_stream:
+                yield receive_stream
+        finally:
+            subscribers.discard(send_stream)
+            if not subscribers:
+                del self._subscribers[channel]
+            send_stream.close()
+
+
+class RedisBus:
+    """A message bus using Redis publish/subscribe, for replicas on multiple machines.
+    It requires the `redis` package and the asyncio backend.
+    """
+
+    def __init__(self, url: str = "redis://localhost:6379") -> None:
+        """Initialize the object.
+
+        Arguments:
+            url: The URL of the Redis server.
+        """
+        from redis.asyncio import Redis  # type: ignore[import-not-found]
+
+        self._redis = Redis.from_url(url)
+
+    async def publish(self, channel: str, message: bytes) -> None:
+        await self._redis.publish(channel, message)
+
+    @asynccontextmanager
+    async def subscribe(self, channel: str) -> AsyncIterator[AsyncIterator[bytes]]:
+        pubsub = self._redis.pubsub()
+        await pubsub.subscribe(channel)
+        try:
+            yield self._receive(pubsub)
+        finally:
+            await pubsub.unsubscribe(channel)
+            await pubsub.aclose()
+
+    async def _receive(self, pubsub: Any) -> AsyncIterator[bytes]:
+        async for message in pubsub.listen():
+            if message["type"] == "message":
+                yield message["data"]
+
+
+class YRoomReplicator:
+    """Replicates a room across nodes through a message bus, so that the clients of the room
+    can be connected to any node.
+
+    The updates of the room's document are published on the bus, and the updates published
+    by the other nodes are applied to it. When a replicator starts, it exchanges state vectors
+    with the other nodes, and only the updates that are missing on each side are sent.
+    """
+
+    room: YRoom
+    channel: str
+    node_id: bytes
+    _ydoc: Doc
+    _update_send_stream: MemoryObjectSendStream
+    _update_receive_stream: MemoryObjectReceiveStream
+    _subscription: Subscription
+    _applying_remote_update: bool
+    _started: Event | None = None
+    _task_group: TaskGroup | None = None
+    __start_lock: Lock | None = None
+
+    def __init__(
+        self,
+        room: YRoom,
+        bus: Bus,
+        channel: str,
+        node_id: str | None = None,
+        log: Logger | None = None,
+    ) -> None:
+        """Initialize the object.
+
+        The YRoomReplicator instance should preferably be used as an async context manager:
+        ```py
+        async with replicator:
+            ...
+        ```
+        However, a lower-level API can also be used:
+        ```py
+        task = asyncio.create_task(replicator.start())
+        await replicator.started.wait()
+        ...
+        await replicator.stop()
+        ```
+
+        Arguments:
+            room: The room to replicate.
+            bus: The message bus through which to replicate the room.
+            channel: The channel of the bus on which the room is replicated,
+                which must be the same on all nodes, e.g. the room name.
+            node_id: The unique ID of this node. Defaults to a random ID.
+            log: An optional logger.
+        """
+        self.room = room
+        self.bus = bus
+        self.channel = channel
+        self.node_id = (node_id or uuid4().hex).encode()
+        self.log = log or getLogger(__name__)
+        self._applying_remote_update = False
+
+    @property
+    def started(self) -> Event:
+        """An async event that is set when the replicator has started."""
+        if self._started is None:
+            self._started = Event()
+        return self._started
+
+    @property
+    def _start_lock(self) -> Lock:
+        if self.__start_lock is None:
+            self.__start_lock = Lock()
+        return self.__start_lock
+
+    def _encode_message(self, kind: bytes, payload: bytes, target: bytes = b"") -> bytes:
+        return b"".join(
+            write_var_uint(len(field)) + field for field in (kind, self.node_id, target, payload)
+        )
+
+    async def _publish(self, kind: bytes, payload: bytes, target: bytes = b"") -> None:
+        await self.bus.publish(self.channel, self._encode_message(kind, payload, target))
+
+    def _put_update(self, event: TransactionEvent) -> None:
+        # updates received from the other nodes are not published back
+        if not self._applying_remote_update:
+            put_updates(self._update_send_stream, event)
+
+    def _apply_update(self, update: bytes) -> None:
+        self._applying_remote_update = True
+        try:
+            self._ydoc.apply_update(update)
+        finally:
+            self._applying_remote_update = False
+
+    async def _run(self, *, task_status: TaskStatus[None] = TASK_STATUS_IGNORED) -> None:
+        assert self._task_group is not None
+        async with self.bus.subscribe(self.channel) as messages:
+            self._task_group.start_soon(self._publish_updates)
+            # ask the other nodes for the updates this node is missing
+            await self._publish(_SYNC_STEP1, self._ydoc.get_state())
+            task_status.started()
+            async for message in messages:
+                try:
+                    await self._handle_message(message)
+                except Exception as exception:
+                    self.log.error("Error while handling replication message", exc_info=exception)
+
+    async def _handle_message(self, message: bytes) -> None:
+        kind, sender, target, payload = Decoder(message).read_messages()
+        if sender == self.node_id or target not in (b"", self.node_id):
+            return
+        if kind == _UPDATE:
+            self._apply_update(payload)
+        elif kind == _SYNC_STEP1:
+            # send the updates the node is missing
+            await self._publish(_SYNC_STEP2, self._ydoc.get_update(payload), sender)
+            if not target:
+                # a node joined, ask it for the updates this node is missing
+                await self._publish(_SYNC_STEP1, self._ydoc.get_state(), sender)
+        elif kind == _SYNC_STEP2:
+            self._apply_update(payload)
+
+    async def _publish_updates(self) -> None:
+        async with self._update_receive_stream:
+            async for update in self._update_receive_stream:
+                try:
+                    await self._publish(_UPDATE, update)
+                except Exception as exception:
+                    self.log.error("Error while publishing update", exc_info=exception)
+
+    async def __aenter__(self) -> YRoomReplicator:
+        async with self._start_lock:
+            if self._task_group is not None:
+                raise RuntimeError("YRoomReplicator already running")
+
+            async with AsyncExitStack() as exit_stack:
+                tg = create_task_group()
+                self._task_group = await exit_stack.enter_async_context(tg)
+                self._exit_stack = exit_stack.pop_all()
+                await tg.start(partial(self.start, from_context_manager=True))
+
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, exc_tb):
+        await self.stop()
+        return await self._exit_stack.__aexit__(exc_type, exc_value, exc_tb)
+
+    async def start(
+        self,
+        *,
+        task_status: TaskStatus[None] = TASK_STATUS_IGNORED,
+        from_context_manager: bool = False,
+    ):
+        """Start the replicator.
+
+        Arguments:
+            task_status: The status to set when the task has started.
+        """
+        self._ydoc = self.room.ydoc
+        self._update_send_stream, self._update_receive_stream = create_memory_object_stream(
+            max_buffer_size=65536
+        )
+        self._subscription = self._ydoc.observe(self._put_update)
+
+        if from_context_manager:
+            assert self._task_group is not None
+            await self._task_group.start(self._run)
+            task_status.started()
+            self.started.set()
+            return
+
+        async with self._start_lock:
+            if self._task_group is not None:
+                raise RuntimeError("YRoomReplicator already running")
+
+            async with create_task_group() as self._task_group:
+                await self._task_group.start(self._run)
+                task_status.started()
+                self.started.set()
+
+    async def stop(self):
+        """Stop the replicator."""
+        if self._task_group is None:
+            raise RuntimeError("YRoomReplicator not running")
+
+        self._task_group.cancel_scope.cancel()
+        self._task_group = None
+        self._ydoc.unobserve(self._subscription)
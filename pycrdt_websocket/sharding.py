@@ -0,0 +1,234 @@
+from __future__ import annotations
+
+import hashlib
+from bisect import bisect, insort
+from inspect import isawaitable
+from logging import Logger, getLogger
+from typing import Any, Awaitable, Callable, Iterable
+
+from anyio import CancelScope, create_task_group
+from httpx_ws import AsyncWebSocketSession, WebSocketDisconnect, aconnect_ws
+
+
+class HashRing:
+    """A consistent hash ring, mapping keys to nodes.
+    When nodes are added or removed, only the keys of these nodes are mapped to other nodes.
+    """
+
+    replicas: int
+    _points: list[int]
+    _nodes: dict[int, str]
+
+    def __init__(self, nodes: Iterable[str] = (), replicas: int = 100) -> None:
+        """Initialize the object.
+
+        Arguments:
+            nodes: The nodes in the ring.
+            replicas: The number of points of each node in the ring. The more points,
+                the more evenly the keys are spread across the nodes.
+        """
+        self.replicas = replicas
+        self._points = []
+        self._nodes = {}
+        for node in nodes:
+            self.add_node(node)
+
+    @property
+    def nodes(self) -> set[str]:
+        """The nodes in the ring."""
+        return set(self._nodes.values())
+
+    def add_node(self, node: str) -> None:
+        """Add a node to the ring.
+
+        Arguments:
+            node: The node to add.
+        """
+        for replica in range(self.replicas):
+            point = _hash(f"{node}#{replica}")
+            if point not in self._nodes:
+                self._nodes[point] = node
+                insort(self._points, point)
+
+    def remove_node(self, node: str) -> None:
+        """Remove a node from the ring.
+
+        Arguments:
+            node: The node to remove.
+        """
+        self._nodes = {point: _node for point, _node in self._nodes.items() if _node != node}
+        self._points = sorted(self._nodes)
+
+    def get_node(self, key: str) -> str:
+        """Get the node a key is mapped to.
+
+        Arguments:
+            key: The key to map.
+
+        Returns:
+            The node the key is mapped to.
+        """
+        if not self._points:
+            raise RuntimeError("No node in the hash ring")
+        index = bisect(self._points, _hash(key)) % len(self._points)
+        return self._nodes[self._points[index]]
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class ShardRouter:
+    """ASGI application routing WebSockets to workers.
+
+    Each worker is a process serving rooms, through an `ASGIServer` with its own
+    `WebsocketServer`. A WebSocket is routed to a worker using consistent hashing on its path,
+    so that all the clients of a room are connected to the same worker, and the rooms are
+    spread across the workers.
+    """
+
+    _ring: HashRing
+    _connections: dict[str, set[CancelScope]]
+
+    def __init__(
+        self,
+        workers: Iterable[str],
+        replicas: int = 100,
+        on_connect: Callable[[dict[str, Any], dict[str, Any]], Awaitable[bool] | bool]
+        | None = None,
+        log: Logger | None = None,
+    ) -> None:
+        """Initialize the object.
+
+        Arguments:
+            workers: The base URLs of the workers, e.g. "http://127.0.0.1:8001".
+            replicas: The number of points of each worker in the hash ring.
+            on_connect: An optional callback to call when connecting the WebSocket.
+                If the callback returns True, the WebSocket is not accepted.
+            log: An optional logger.
+        """
+        self._ring = HashRing(workers, replicas)
+        self._on_connect = on_connect
+        self.log = log or getLogger(__name__)
+        self._connections = {}
+
+    @property
+    def workers(self) -> set[str]:
+        """The base URLs of the workers."""
+        return self._ring.nodes
+
+    def get_worker(self, path: str) -> str:
+        """Get the worker serving a room.
+
+        Arguments:
+            path: The WebSocket path of the room.
+
+        Returns:
+            The base URL of the worker.
+        """
+        return self._ring.get_node(path)
+
+    def set_workers(self, workers: Iterable[str]) -> None:
+        """Change the workers, and rebalance the rooms.
+        The WebSockets of the rooms now served by another worker are closed, so that their
+        clients reconnect to the new worker, which loads the rooms.
+
+        Arguments:
+            workers: The base URLs of the workers.
+        """
+        ring = HashRing(workers, self._ring.replicas)
+        for path, connections in self._connections.items():
+            if ring.get_node(path) != self._ring.get_node(path):
+                self.log.debug("Moving room %s to worker %s", path, ring.get_node(path))
+                for connection in connections:
+                    connection.cancel()
+        self._ring = ring
+
+    async def __call__(
+        self,
+        scope: dict[str, Any],
+        receive: Callable[[], Awaitable[dict[str, Any]]],
+        send: Callable[[dict[str, Any]], Awaitable[None]],
+    ):
+        if scope["type"] == "lifespan":
+            while True:
+                msg = await receive()
+                if msg["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                elif msg["type"] == "lifespan.shutdown":
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+
+        msg = await receive()
+        if msg["type"] != "websocket.connect":
+            return
+
+        if self._on_connect is not None:
+            close = self._on_connect(msg, scope)
+            if isawaitable(close):
+                close = await close
+            if close:
+                return
+
+        path = scope["path"]
+        url = self.get_worker(path).rstrip("/") + path
+        if scope.get("query_string"):
+            url += "?" + scope["query_string"].decode()
+        connection = CancelScope()
+        self._connections.setdefault(path, set()).add(connection)
+        worker: AsyncWebSocketSession
+        disconnected = False
+        code = 1000
+        try:
+            with connection:
+                async with aconnect_ws(url, subprotocols=scope.get("subprotocols")) as worker:
+                    await send({"type": "websocket.accept", "subprotocol": worker.subprotocol})
+                    disconnected = await self._forward(receive, send, worker)
+        except Exception as exception:
+            self.log.error("Error while routing WebSocket to %s", url, exc_info=exception)
+            code = 1011
+        finally:
+            connections = self._connections[path]
+            connections.discard(connection)
+            if not connections:
+                del self._connections[path]
+        if connection.cancel_called:
+            # the room was moved to another worker,
+            # 1012 (service restart) tells the client to reconnect
+            code = 1012
+        if not disconnected:
+            await send({"type": "websocket.close", "code": code})
+
+    async def _forward(
+        self,
+        receive: Callable[[], Awaitable[dict[str, Any]]],
+        send: Callable[[dict[str, Any]], Awaitable[None]],
+        worker: AsyncWebSocketSession,
+    ) -> bool:
+        # forward messages in both directions until one side closes the connection,
+        # and return whether it was the client
+        disconnected = False
+
+        async def forward_to_worker() -> None:
+            nonlocal disconnected
+            while True:
+                message = await receive()
+                if message["type"] == "websocket.disconnect":
+                    disconnected = True
+                    tg.cancel_scope.cancel()
+                    return
+                if message.get("bytes") is not None:
+                    await worker.send_bytes(message["bytes"])
+                elif message.get("text") is not None:
+                    await worker.send_text(message["text"])
+
+        async with create_task_group() as tg:
+            tg.start_soon(forward_to_worker)
+            while True:
+                try:
+                    message = await worker.receive_bytes()
+                except WebSocketDisconnect:
+                    tg.cancel_scope.cancel()
+                    break
+                await send({"type": "websocket.send", "bytes": message})
+        return disconnected
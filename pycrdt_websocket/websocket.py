@@ -1,4 +1,4 @@
-from typing import Protocol
+from typing import Any, Protocol
 
 from anyio import Lock
 
@@ -20,6 +20,14 @@ class Websocket(Protocol):
     ```py
     await websocket.send(message)
     ```
+    When the same message is sent to many WebSockets (e.g. to all the clients of a room),
+    transports that can frame a message once for all their connections may also implement
+    a `prepare_message()` class method and a `send_prepared()` method:
+    ```py
+    frame = type(websocket).prepare_message(message)
+    for websocket in websockets:
+        await websocket.send_prepared(frame)
+    ```
     """
 
     @property
@@ -75,9 +83,18 @@ class HttpxWebsocket(Websocket):
             raise StopAsyncIteration()
         return message
 
+    @classmethod
+    def prepare_message(cls, message: bytes) -> Any:
+        from wsproto.events import BytesMessage
+
+        return BytesMessage(data=message)
+
     async def send(self, message: bytes):
+        await self.send_prepared(self.prepare_message(message))
+
+    async def send_prepared(self, frame: Any) -> None:
         async with self._send_lock:
-            await self._websocket.send_bytes(message)
+            await self._websocket.send(frame)
 
     async def recv(self) -> bytes:
         b = await self._websocket.receive_bytes()
@@ -3,20 +3,40 @@ from __future__ import annotations
 from contextlib import AsyncExitStack
 from functools import partial
 from logging import Logger, getLogger
-from typing import Callable
+from typing import Awaitable, Callable
 
-from anyio import TASK_STATUS_IGNORED, Event, Lock, create_task_group
+from anyio import TASK_STATUS_IGNORED, CancelScope, Event, Lock, create_task_group, sleep
 from anyio.abc import TaskGroup, TaskStatus
 
 from .websocket import Websocket
 from .yroom import YRoom
+from .ystore import BaseYStore, YDocNotFound
 
 
 class WebsocketServer:
     """WebSocket server."""
 
     auto_clean_rooms: bool
+    room_ttl: float | None
+    max_idle_rooms: int | None
     rooms: dict[str, YRoom]
+    # the number of idle rooms reused by a client, and the number of rooms loaded
+    room_hits: int
+    room_misses: int
+    room_factory: Callable[[str], Awaitable[YRoom]] | None
+    ystore_factory: Callable[[str], BaseYStore] | None
+    # the rooms without clients which are kept until they are evicted, from the least recently
+    # used one, with the scope of the task evicting them when their TTL expires
+    _idle_rooms: dict[str, CancelScope]
+    # the rooms being created and the rooms being started, so that concurrent calls
+    # wait for a room to be created or started once
+    _room_creations: dict[str, _RoomCreation]
+    _room_starts: dict[YRoom, Event]
+    # the names of the rooms, kept in sync with "rooms" by the server's methods,
+    # but verified since "rooms" can also be modified directly
+    _room_names: dict[YRoom, str]
+    # the stores created with "ystore_factory", which are stopped with their room
+    _room_ystores: dict[YRoom, BaseYStore]
     _started: Event | None = None
     _stopped: Event
     _task_group: TaskGroup | None = None
@@ -26,6 +46,10 @@ class WebsocketServer:
         self,
         rooms_ready: bool = True,
         auto_clean_rooms: bool = True,
+        room_ttl: float | None = None,
+        max_idle_rooms: int | None = None,
+        room_factory: Callable[[str], Awaitable[YRoom]] | None = None,
+        ystore_factory: Callable[[str], BaseYStore] | None = None,
         exception_handler: Callable[[Exception, Logger], bool] | None = None,
         log: Logger | None = None,
     ) -> None:
@@ -47,15 +71,39 @@ class WebsocketServer:
         Arguments:
             rooms_ready: Whether rooms are ready to be synchronized when opened.
             auto_clean_rooms: Whether rooms should be deleted when no client is there anymore.
+            room_ttl: The time (in seconds) during which a room without clients is kept
+                before being deleted, if `auto_clean_rooms` is True, so that clients reconnecting
+                to it don't have to wait for it to be loaded again. Defaults to deleting it
+                right away, unless `max_idle_rooms` is set.
+            max_idle_rooms: The maximum number of rooms without clients which are kept, if
+                `auto_clean_rooms` is True. Beyond that, the least recently used ones are
+                deleted. Defaults to no maximum.
+            room_factory: An optional async callback to call with a room name to create
+                the room with that name, which is then started by the server.
+                Defaults to creating a room with the YStore returned by `ystore_factory`.
+            ystore_factory: An optional callback to call with a room name to create the store
+                of the room with that name, from which the room's document is loaded before
+                clients can join the room. Defaults to rooms without stores.
             exception_handler: An optional callback to call when an exception is raised, that
                 returns True if the exception was handled.
             log: An optional logger.
         """
         self.rooms_ready = rooms_ready
         self.auto_clean_rooms = auto_clean_rooms
+        self.room_ttl = room_ttl
+        self.max_idle_rooms = max_idle_rooms
+        self.room_factory = room_factory
+        self.ystore_factory = ystore_factory
         self.exception_handler = exception_handler
         self.log = log or getLogger(__name__)
         self.rooms = {}
+        self.room_hits = 0
+        self.room_misses = 0
+        self._idle_rooms = {}
+        self._room_creations = {}
+        self._room_starts = {}
+        self._room_names = {}
+        self._room_ystores = {}
         self._stopped = Event()
 
     @property
@@ -80,12 +128,73 @@ class WebsocketServer:
         Returns:
             The room with the given name, or a new one if no room with that name was found.
         """
-        if name not in self.rooms.keys():
-            self.rooms[name] = YRoom(ready=self.rooms_ready, log=self.log)
+        while name not in self.rooms.keys():
+            creation = self._room_creations.get(name)
+            if creation is None:
+                self.room_misses += 1
+                return await self._create_room_once(name)
+            # another call is creating the room, wait for it
+            await creation.done.wait()
+            if creation.exception is not None:
+                raise RuntimeError(f"Could not create room: {name}") from creation.exception
+            # if the creation was cancelled, try again
+        if self._use_room(name):
+            self.room_hits += 1
         room = self.rooms[name]
         await self.start_room(room)
         return room
 
+    async def _create_room_once(self, name: str) -> YRoom:
+        creation = self._room_creations[name] = _RoomCreation()
+        try:
+            room = await self._create_room(name)
+        except Exception as exception:
+            creation.exception = exception
+            raise
+        else:
+            self.rooms[name] = room
+            self._room_names[room] = name
+            return room
+        finally:
+            del self._room_creations[name]
+            creation.done.set()
+
+    async def _create_room(self, name: str) -> YRoom:
+        """Create a room, start it and load its document from its store, if any.
+
+        Arguments:
+            name: The room name.
+
+        Returns:
+            The started room.
+        """
+        if self.room_factory is not None:
+            room = await self.room_factory(name)
+            await self.start_room(room)
+            return room
+
+        if self.ystore_factory is None:
+            room = YRoom(ready=self.rooms_ready, log=self.log)
+            await self.start_room(room)
+            return room
+
+        ystore = self.ystore_factory(name)
+        # the room is not ready while the document is loaded,
+        # so that the stored updates are not written back to the store
+        room = YRoom(ready=False, ystore=ystore, log=self.log)
+        self._room_ystores[room] = ystore
+        try:
+            await self.start_room(room)
+            await ystore.started.wait()
+            await ystore.apply_updates(room.ydoc)
+        except YDocNotFound:
+            pass
+        except BaseException:
+            await self._stop_room(room)
+            raise
+        room.ready = self.rooms_ready
+        return room
+
     async def start_room(self, room: YRoom) -> None:
         """Start a room, if not already started.
 
@@ -98,8 +207,18 @@ class WebsocketServer:
                 "`await websocket_server.start()`"
             )
 
-        if not room.started.is_set():
-            await self._task_group.start(room.start)
+        while not room.started.is_set():
+            starting = self._room_starts.get(room)
+            if starting is not None:
+                # another call is starting the room, wait for it
+                await starting.wait()
+                continue
+            starting = self._room_starts[room] = Event()
+            try:
+                await self._task_group.start(room.start)
+            finally:
+                del self._room_starts[room]
+                starting.set()
 
     def get_room_name(self, room: YRoom) -> str:
         """Get the name of a room.
@@ -110,7 +229,15 @@ class WebsocketServer:
         Returns:
             The room name.
         """
-        return list(self.rooms.keys())[list(self.rooms.values()).index(room)]
+        name = self._room_names.get(room)
+        if name is not None and self.rooms.get(name) is room:
+            return name
+        # the rooms were modified directly
+        for name, _room in self.rooms.items():
+            if _room is room:
+                self._room_names[room] = name
+                return name
+        raise ValueError(f"{room} is not in rooms")
 
     def rename_room(
         self, to_name: str, *, from_name: str | None = None, from_room: YRoom | None = None
@@ -127,7 +254,10 @@ class WebsocketServer:
         if from_name is None:
             assert from_room is not None
             from_name = self.get_room_name(from_room)
-        self.rooms[to_name] = self.rooms.pop(from_name)
+        room = self.rooms[to_name] = self.rooms.pop(from_name)
+        self._room_names[room] = to_name
+        if from_name in self._idle_rooms:
+            self._idle_rooms[to_name] = self._idle_rooms.pop(from_name)
 
     async def delete_room(self, *, name: str | None = None, room: YRoom | None = None) -> None:
         """Delete a room.
@@ -141,8 +271,67 @@ class WebsocketServer:
         if name is None:
             assert room is not None
             name = self.get_room_name(room)
+        self._use_room(name)
         room = self.rooms.pop(name)
-        await room.stop()
+        self._room_names.pop(room, None)
+        await self._stop_room(room)
+
+    async def _stop_room(self, room: YRoom) -> None:
+        # stop the room, and its store if it was created by the server
+        ystore = self._room_ystores.pop(room, None)
+        if room.started.is_set():
+            await room.stop()
+        if ystore is not None and ystore.started.is_set():
+            await ystore.stop()
+
+    async def _release_room(self, room: YRoom) -> None:
+        """Delete a room without clients, or keep it as an idle room until it is evicted.
+
+        Arguments:
+            room: The room without clients.
+        """
+        try:
+            name = self.get_room_name(room)
+        except ValueError:
+            # the room was already released by another client leaving it
+            return
+        if self.room_ttl is None and self.max_idle_rooms is None:
+            await self.delete_room(name=name)
+            return
+
+        if name in self._idle_rooms:
+            return
+        assert self._task_group is not None
+        scope = self._idle_rooms[name] = CancelScope()
+        if self.room_ttl is not None:
+            self._task_group.start_soon(self._evict_room_after_ttl, name, scope)
+        if self.max_idle_rooms is not None:
+            while len(self._idle_rooms) > self.max_idle_rooms:
+                await self._evict_room(next(iter(self._idle_rooms)))
+
+    def _use_room(self, name: str) -> bool:
+        # returns whether the room was idle
+        scope = self._idle_rooms.pop(name, None)
+        if scope is None:
+            return False
+        scope.cancel()
+        return True
+
+    async def _evict_room_after_ttl(self, name: str, scope: CancelScope) -> None:
+        assert self.room_ttl is not None
+        with scope:
+            await sleep(self.room_ttl)
+        if self._idle_rooms.get(name) is scope:
+            await self._evict_room(name)
+
+    async def _evict_room(self, name: str) -> None:
+        # the room's YStore is flushed when the room is stopped, and stopped if it was
+        # created by the server
+        self.log.debug("Evicting idle room %s", name)
+        try:
+            await self.delete_room(name=name)
+        except Exception as exception:
+            self._handle_exception(exception)
 
     async def serve(self, websocket: Websocket) -> None:
         """Serve a client through a WebSocket.
@@ -162,7 +351,7 @@ class WebsocketServer:
                 await self.start_room(room)
                 await room.serve(websocket)
                 if self.auto_clean_rooms and not room.clients:
-                    await self.delete_room(room=room)
+                    await self._release_room(room)
         except Exception as exception:
             self._handle_exception(exception)
 
@@ -230,8 +419,31 @@ class WebsocketServer:
             raise RuntimeError("WebsocketServer not running")
 
         self._stopped.set()
-        self._task_group.cancel_scope.cancel()
-        self._task_group = None
+        try:
+            # the rooms are stopped, so that their pending updates are written to their stores,
+            # and the stores created by the server are stopped
+            for scope in self._idle_rooms.values():
+                scope.cancel()
+            self._idle_rooms.clear()
+            for name, room in list(self.rooms.items()):
+                del self.rooms[name]
+                self._room_names.pop(room, None)
+                try:
+                    await self._stop_room(room)
+                except Exception as exception:
+                    self._handle_exception(exception)
+        finally:
+            self._task_group.cancel_scope.cancel()
+            self._task_group = None
+
+
+class _RoomCreation:
+    done: Event
+    exception: Exception | None
+
+    def __init__(self) -> None:
+        self.done = Event()
+        self.exception = None
 
 
 def exception_logger(exception: Exception, log: Logger) -> bool:
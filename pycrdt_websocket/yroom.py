@@ -4,16 +4,25 @@ from contextlib import AsyncExitStack
 from functools import partial
 from inspect import isawaitable
 from logging import Logger, getLogger
-from typing import Any, Awaitable, Callable
+from typing import Any, Awaitable, Callable, Literal
 
 from anyio import (
     TASK_STATUS_IGNORED,
+    BrokenResourceError,
+    CancelScope,
+    CapacityLimiter,
+    ClosedResourceError,
+    EndOfStream,
     Event,
     Lock,
+    WouldBlock,
     create_memory_object_stream,
     create_task_group,
+    move_on_after,
+    sleep,
 )
 from anyio.abc import TaskGroup, TaskStatus
+from anyio.lowlevel import checkpoint
 from anyio.streams.memory import MemoryObjectReceiveStream, MemoryObjectSendStream
 from pycrdt import (
     Awareness,
@@ -26,12 +35,79 @@ from pycrdt import (
     create_update_message,
     handle_sync_message,
     is_awareness_disconnect_message,
+    merge_updates,
     read_message,
+    write_message,
 )
 
 from .websocket import Websocket
 from .ystore import BaseYStore
-from .yutils import put_updates
+from .yutils import (
+    put_updates,
+    read_awareness_update,
+    read_state_vector,
+    run_sync,
+    write_awareness_update,
+    write_state_vector,
+)
+
+
+class _ClientQueue:
+    """The queue of messages waiting to be sent to a client."""
+
+    def __init__(self, websocket: Websocket, max_buffer_size: int, cancel_scope: CancelScope):
+        self.websocket = websocket
+        self.cancel_scope = cancel_scope
+        self.send_stream: MemoryObjectSendStream[Any]
+        self.receive_stream: MemoryObjectReceiveStream[Any]
+        self.send_stream, self.receive_stream = create_memory_object_stream(
+            max_buffer_size=max_buffer_size
+        )
+        # transports that can frame a message once for all their connections
+        # implement prepare_message() and send_prepared()
+        self.prepare_message = getattr(type(websocket), "prepare_message", None)
+        self.send_prepared = getattr(websocket, "send_prepared", None)
+        if self.prepare_message is None or self.send_prepared is None:
+            self.prepare_message = self.send_prepared = None
+
+    def prepare(self, message: bytes, frames: dict[type, Any] | None = None) -> Any:
+        """Prepare a message to be queued.
+
+        Arguments:
+            message: The message to prepare.
+            frames: An optional cache of the frames already prepared for this message,
+                by transport type.
+
+        Returns:
+            The prepared frame, or the message itself if the transport cannot prepare frames.
+        """
+        if self.prepare_message is None:
+            return message
+        if frames is None:
+            return self.prepare_message(message)
+        frame_type = type(self.websocket)
+        if frame_type not in frames:
+            frames[frame_type] = self.prepare_message(message)
+        return frames[frame_type]
+
+    async def run(self) -> None:
+        """Send the queued messages to the client, until the queue is closed."""
+        send = self.websocket.send if self.send_prepared is None else self.send_prepared
+        async with self.receive_stream:
+            async for frame in self.receive_stream:
+                await send(frame)
+
+    def clear(self) -> None:
+        """Drop the queued messages."""
+        while True:
+            try:
+                self.receive_stream.receive_nowait()
+            except WouldBlock:
+                break
+
+    def close(self) -> None:
+        """Close the queue, the queued messages will still be sent."""
+        self.send_stream.close()
 
 
 class YRoom:
@@ -39,6 +115,17 @@ class YRoom:
     ydoc: Doc
     ystore: BaseYStore | None
     ready_event: Event
+    batch_max_delay: float | None
+    batch_max_size: int | None
+    updates_received: int
+    update_messages_sent: int
+    send_queue_size: int
+    slow_client_policy: Literal["block", "resync", "disconnect"]
+    awareness_flush_interval: float | None
+    lightweight_awareness: bool
+    sync_step2_chunk_size: int | None
+    offload_threshold: int | None
+    offload_limiter: CapacityLimiter | None
     _on_message: Callable[[bytes], Awaitable[bool] | bool] | None
     _update_send_stream: MemoryObjectSendStream
     _update_receive_stream: MemoryObjectReceiveStream
@@ -47,6 +134,12 @@ class YRoom:
     _stopped: Event
     __start_lock: Lock | None = None
     _subscription: Subscription | None = None
+    _client_queues: dict[Websocket, _ClientQueue]
+    _pending_awareness: set[int]
+    _pending_awareness_entries: dict[int, tuple[int, bytes]]
+    _awareness_clocks: dict[int, int]
+    _client_awareness_ids: dict[Websocket, set[int]]
+    _awareness_pending: Event
 
     def __init__(
         self,
@@ -55,6 +148,15 @@ class YRoom:
         exception_handler: Callable[[Exception, Logger], bool] | None = None,
         log: Logger | None = None,
         ydoc: Doc | None = None,
+        batch_max_delay: float | None = None,
+        batch_max_size: int | None = None,
+        send_queue_size: int = 1024,
+        slow_client_policy: Literal["block", "resync", "disconnect"] = "resync",
+        awareness_flush_interval: float | None = None,
+        lightweight_awareness: bool = False,
+        sync_step2_chunk_size: int | None = None,
+        offload_threshold: int | None = None,
+        offload_limiter: CapacityLimiter | None = None,
     ):
         """Initialize the object.
 
@@ -78,7 +180,45 @@ class YRoom:
                 returns True if the exception was handled.
             log: An optional logger.
             ydoc: An optional document for the room (a new one is created otherwise).
+            batch_max_delay: If set, enable batching: the updates received within this delay
+                (in seconds) are merged and broadcast to clients as a single message.
+            batch_max_size: The maximum size (in bytes) of the updates merged in a batch,
+                after which the batch is broadcast without waiting for `batch_max_delay`.
+            send_queue_size: The maximum number of messages waiting to be sent to each client.
+            slow_client_policy: What to do when the send queue of a client is full:
+                - "resync" (default): drop the queued messages and resynchronize the client.
+                - "disconnect": disconnect the client.
+                - "block": wait until there is room in the queue. Updates are broadcast to
+                  all the clients one after the other, so a single slow client then stalls
+                  the whole room, and updates may be dropped if they keep coming in.
+            awareness_flush_interval: If set, coalesce awareness: the awareness updates
+                received from clients are applied to the room's awareness, and the latest
+                states of the clients that changed are broadcast as a single message at most
+                once per interval (in seconds). Client disconnections are still broadcast
+                right away.
+            lightweight_awareness: If True, the awareness states of the clients are not
+                decoded and not kept in the room's awareness, which only holds the server's
+                own state. The room only tracks the IDs and clocks of the clients, in order
+                to broadcast their removal when their WebSocket closes without a
+                disconnection message.
+            sync_step2_chunk_size: If set, the document state sent to a client joining
+                the room is split into update messages of about this size (in bytes),
+                instead of a single SYNC_STEP2 message. The updates are built and sent
+                one after the other, waiting for the client to receive them, so that the
+                whole state is never held in memory and the event loop is not blocked
+                while the whole document is encoded. Otherwise, the document state is
+                encoded at once in the event loop thread, as is the state sent to a slow
+                client that is resynchronized.
+            offload_threshold: If set, the updates merged in a batch or in a chunk of the
+                document state are merged in a worker process when they are larger than this
+                size (in bytes), so that merging them doesn't block the event loop. The
+                document itself cannot be encoded in a worker process, so this only helps
+                with clients joining the room if `sync_step2_chunk_size` is also set.
+            offload_limiter: An optional capacity limiter for these worker processes,
+                e.g. shared by all the rooms.
         """
+        if send_queue_size < 2:
+            raise ValueError("send_queue_size must be at least 2")
         self.ydoc = Doc() if ydoc is None else ydoc
         self.ready_event = Event()
         self.ready = ready
@@ -86,9 +226,27 @@ class YRoom:
         self.log = log or getLogger(__name__)
         self.awareness = Awareness(self.ydoc)
         self.awareness.observe(self.send_server_awareness)
+        self.awareness.observe(self._collect_awareness)
         self.clients = set()
         self._on_message = None
         self.exception_handler = exception_handler
+        self.batch_max_delay = batch_max_delay
+        self.batch_max_size = batch_max_size
+        self.updates_received = 0
+        self.update_messages_sent = 0
+        self.send_queue_size = send_queue_size
+        self.slow_client_policy = slow_client_policy
+        self._client_queues = {}
+        self.awareness_flush_interval = awareness_flush_interval
+        self.lightweight_awareness = lightweight_awareness
+        self._pending_awareness = set()
+        self._pending_awareness_entries = {}
+        self._awareness_clocks = {}
+        self._client_awareness_ids = {}
+        self.sync_step2_chunk_size = sync_step2_chunk_size
+        self.offload_threshold = offload_threshold
+        self.offload_limiter = offload_limiter
+        self._awareness_pending = Event()
         self._stopped = Event()
 
     @property
@@ -151,24 +309,52 @@ class YRoom:
             async for update in self._update_receive_stream:
                 if self._task_group.cancel_scope.cancel_called:
                     return
+                if self.batch_max_delay is None:
+                    self.updates_received += 1
+                else:
+                    updates = await self._receive_batch(update)
+                    self.updates_received += len(updates)
+                    update = await self._merge_updates(updates)
+                # queue the update for the store first, so that it is persisted
+                # even if broadcasting it to the clients takes time
+                if self.ystore:
+                    try:
+                        self._task_group.start_soon(self.ystore.write, update)
+                        self.log.debug("Writing Y update to YStore")
+                    except Exception as exception:
+                        self._handle_exception(exception)
                 # broadcast internal ydoc's update to all clients, that includes changes from the
                 # clients and changes from the backend (out-of-band changes)
                 if self.clients:
                     message = create_update_message(update)
-                    for client in self.clients:
+                    self.update_messages_sent += 1
+                    frames: dict[type, Any] = {}
+                    for client in list(self.clients):
                         try:
                             self.log.debug(
                                 "Sending Y update to client with endpoint: %s", client.path
                             )
-                            self._task_group.start_soon(client.send, message)
+                            await self._send(client, message, frames)
                         except Exception as exception:
                             self._handle_exception(exception)
-                if self.ystore:
+
+    async def _receive_batch(self, update: bytes) -> list[bytes]:
+        # drain the updates waiting on the stream, and wait for new ones
+        # until the batch delay expires or the batch size is reached
+        updates = [update]
+        size = len(update)
+        with move_on_after(self.batch_max_delay):
+            while self.batch_max_size is None or size < self.batch_max_size:
+                try:
                     try:
-                        self._task_group.start_soon(self.ystore.write, update)
-                        self.log.debug("Writing Y update to YStore")
-                    except Exception as exception:
-                        self._handle_exception(exception)
+                        update = self._update_receive_stream.receive_nowait()
+                    except WouldBlock:
+                        update = await self._update_receive_stream.receive()
+                except EndOfStream:
+                    break
+                updates.append(update)
+                size += len(update)
+        return updates
 
     async def __aenter__(self) -> YRoom:
         async with self._start_lock:
@@ -205,16 +391,19 @@ class YRoom:
             task_status: The status to set when the task has started.
         """
         if from_context_manager:
+            assert self._task_group is not None
+            # the awareness is started first, so that the room can be stopped right away
+            await self._task_group.start(self.awareness.start)
             task_status.started()
             self.started.set()
             self._update_send_stream, self._update_receive_stream = create_memory_object_stream(
                 max_buffer_size=65536
             )
-            assert self._task_group is not None
             self._task_group.start_soon(self._stopped.wait)
             self._task_group.start_soon(self._watch_ready)
             self._task_group.start_soon(self._broadcast_updates)
-            self._task_group.start_soon(self.awareness.start)
+            if self.awareness_flush_interval is not None:
+                self._task_group.start_soon(self._flush_awareness)
             return
 
         async with self._start_lock:
@@ -224,6 +413,9 @@ class YRoom:
             while True:
                 try:
                     async with create_task_group() as self._task_group:
+                        # the awareness is started first, so that the room can be stopped
+                        # right away
+                        await self._task_group.start(self.awareness.start)
                         if not self.started.is_set():
                             task_status.started()
                             self.started.set()
@@ -233,7 +425,8 @@ class YRoom:
                         self._task_group.start_soon(self._stopped.wait)
                         self._task_group.start_soon(self._watch_ready)
                         self._task_group.start_soon(self._broadcast_updates)
-                        self._task_group.start_soon(self.awareness.start)
+                        if self.awareness_flush_interval is not None:
+                            self._task_group.start_soon(self._flush_awareness)
                     return
                 except Exception as exception:
                     await self.awareness.stop()
@@ -243,6 +436,8 @@ class YRoom:
         """Stop the room."""
         if self._task_group is None:
             raise RuntimeError("YRoom not running")
+        if self.ystore is not None and self.ystore.started.is_set():
+            await self.ystore.flush()
         self._stopped.set()
         await self.awareness.stop()
         self._task_group.cancel_scope.cancel()
@@ -256,8 +451,14 @@ class YRoom:
         Arguments:
             websocket: The WebSocket through which to serve the client.
         """
+        queue: _ClientQueue | None = None
         try:
             async with create_task_group() as tg:
+                # messages to this client are queued and sent by a dedicated task,
+                # so that a slow client doesn't hold up the other clients
+                queue = _ClientQueue(websocket, self.send_queue_size, tg.cancel_scope)
+                self._client_queues[websocket] = queue
+                tg.start_soon(queue.run)
                 self.clients.add(websocket)
                 sync_message = create_sync_message(self.ydoc)
                 self.log.debug(
@@ -265,7 +466,7 @@ class YRoom:
                     YSyncMessageType.SYNC_STEP1.name,
                     websocket.path,
                 )
-                await websocket.send(sync_message)
+                await self._send(websocket, sync_message)
                 async for message in websocket:
                     # filter messages (e.g. awareness)
                     skip = False
@@ -284,6 +485,14 @@ class YRoom:
                             YSyncMessageType(message[1]).name,
                             websocket.path,
                         )
+                        if (
+                            self.sync_step2_chunk_size is not None
+                            and message[1] == YSyncMessageType.SYNC_STEP1
+                        ):
+                            await self._send_sync_step2_chunks(
+                                websocket, read_message(message[2:])
+                            )
+                            continue
                         reply = handle_sync_message(message[1:], self.ydoc)
                         if reply is not None:
                             self.log.debug(
@@ -291,7 +500,7 @@ class YRoom:
                                 YSyncMessageType.SYNC_STEP2.name,
                                 websocket.path,
                             )
-                            tg.start_soon(websocket.send, reply)
+                            await self._send(websocket, reply)
                     elif message_type == YMessageType.AWARENESS:
                         # forward awareness messages from this client to all clients,
                         # including itself, because it's used to keep the connection alive
@@ -303,11 +512,25 @@ class YRoom:
 
                         # Check if the message is a client  awareness disconnect.
                         disconnection = is_awareness_disconnect_message(message[1:])
+                        if self.lightweight_awareness:
+                            entries = self._track_awareness(websocket, read_message(message[1:]))
+                        if self.awareness_flush_interval is not None and not disconnection:
+                            # the changed client states are broadcast by _flush_awareness
+                            if not self.lightweight_awareness:
+                                self.awareness.apply_awareness_update(
+                                    read_message(message[1:]), self
+                                )
+                            elif entries:
+                                for client_id, clock, state in entries:
+                                    self._pending_awareness_entries[client_id] = (clock, state)
+                                self._awareness_pending.set()
+                            continue
+                        frames: dict[type, Any] = {}
 
                         # Propagate the message to all clients except itself if it is a
                         # disconnection from the client. This avoid an error when trying
                         # to send the message to the disconnected client.
-                        for client in self.clients:
+                        for client in list(self.clients):
                             if disconnection and client == websocket:
                                 continue
 
@@ -317,14 +540,153 @@ class YRoom:
                                 websocket.path,
                                 client.path,
                             )
-                            tg.start_soon(client.send, message)
+                            await self._send(client, message, frames)
                         # apply awareness update to the server's awareness
-                        self.awareness.apply_awareness_update(read_message(message[1:]), self)
+                        if not self.lightweight_awareness:
+                            self.awareness.apply_awareness_update(read_message(message[1:]), self)
+                # no more messages will be queued, let the sender task flush the queue
+                self._remove_client(websocket)
+                queue.close()
         except Exception as exception:
             self._handle_exception(exception)
         finally:
             # remove this client
-            self.clients.remove(websocket)
+            self._remove_client(websocket)
+            self._remove_client_awareness(websocket)
+            if queue is not None:
+                queue.close()
+                queue.receive_stream.close()
+
+    async def _send_sync_step2_chunks(self, websocket: Websocket, state: bytes) -> None:
+        """Send the updates a client is missing in chunks, as update messages
+        followed by a SYNC_STEP2 message.
+
+        Each chunk holds the missing updates of some of the document's clients (Y clients,
+        not WebSockets), which is obtained from a state vector where the other clients are
+        up-to-date. A chunk is thus as large as the updates of its largest client.
+
+        Arguments:
+            websocket: The WebSocket of the client.
+            state: The state vector of the client.
+        """
+        assert self.sync_step2_chunk_size is not None
+        remote_state = read_state_vector(state)
+        local_state = read_state_vector(self.ydoc.get_state())
+        client_ids = [
+            client_id
+            for client_id, clock in local_state.items()
+            if remote_state.get(client_id, 0) < clock
+        ]
+        updates: list[bytes] = []
+        size = 0
+        for index, client_id in enumerate(client_ids):
+            client_state = dict(local_state)
+            client_state[client_id] = remote_state.get(client_id, 0)
+            update = self.ydoc.get_update(write_state_vector(client_state))
+            # let the other rooms and clients run between the encodes of the document
+            await checkpoint()
+            updates.append(update)
+            size += len(update)
+            if size >= self.sync_step2_chunk_size and index < len(client_ids) - 1:
+                update = await self._merge_updates(updates)
+                updates, size = [], 0
+                self.log.debug("Sending Y update chunk to endpoint: %s", websocket.path)
+                await self._send_chunk(websocket, create_update_message(update))
+        if not updates:
+            updates = [self.ydoc.get_update(state)]
+        update = await self._merge_updates(updates)
+        self.log.debug(
+            "Sending %s message to endpoint: %s",
+            YSyncMessageType.SYNC_STEP2.name,
+            websocket.path,
+        )
+        reply = bytes([YMessageType.SYNC, YSyncMessageType.SYNC_STEP2]) + write_message(update)
+        await self._send_chunk(websocket, reply)
+
+    async def _send_chunk(self, websocket: Websocket, message: bytes) -> None:
+        """Queue a chunk of the document state to be sent to a joining client, waiting
+        for its send queue to have room, whatever the slow client policy.
+
+        Only the serve loop of this client waits, so the chunks are sent at the pace of
+        the client instead of overflowing its queue, which would resynchronize it with
+        the whole document state.
+
+        Arguments:
+            websocket: The WebSocket of the client.
+            message: The message to send.
+        """
+        queue = self._client_queues.get(websocket)
+        if queue is None:
+            # the client is gone
+            return
+
+        try:
+            await queue.send_stream.send(queue.prepare(message))
+        except (BrokenResourceError, ClosedResourceError):
+            # the client is gone
+            pass
+
+    async def _merge_updates(self, updates: list[bytes]) -> bytes:
+        """Merge updates, in a worker process if they are larger than `offload_threshold`.
+
+        Arguments:
+            updates: The updates to merge.
+
+        Returns:
+            The merged update.
+        """
+        if len(updates) == 1:
+            return updates[0]
+        return await run_sync(
+            merge_updates,
+            *updates,
+            size=sum(len(update) for update in updates),
+            threshold=self.offload_threshold,
+            limiter=self.offload_limiter,
+        )
+
+    def _remove_client(self, websocket: Websocket) -> None:
+        self.clients.discard(websocket)
+        self._client_queues.pop(websocket, None)
+
+    async def _send(
+        self, client: Websocket, message: bytes, frames: dict[type, Any] | None = None
+    ) -> None:
+        """Queue a message to be sent to a client, applying the slow client policy
+        if the client's send queue is full.
+
+        Arguments:
+            client: The client to send the message to.
+            message: The message to send.
+            frames: An optional cache of the frames prepared for this message, to share
+                between clients.
+        """
+        queue = self._client_queues.get(client)
+        if queue is None:
+            # the client is gone
+            return
+
+        frame = queue.prepare(message, frames)
+        try:
+            if self.slow_client_policy == "block":
+                await queue.send_stream.send(frame)
+            else:
+                queue.send_stream.send_nowait(frame)
+        except (BrokenResourceError, ClosedResourceError):
+            # the client is gone
+            pass
+        except WouldBlock:
+            if self.slow_client_policy == "disconnect":
+                self.log.warning("Disconnecting slow client with endpoint: %s", client.path)
+                queue.cancel_scope.cancel()
+                self._remove_client(client)
+            else:
+                self.log.warning("Resynchronizing slow client with endpoint: %s", client.path)
+                # the queued messages are superseded by the whole document state
+                queue.clear()
+                queue.send_stream.send_nowait(queue.prepare(create_sync_message(self.ydoc)))
+                update_message = create_update_message(self.ydoc.get_update())
+                queue.send_stream.send_nowait(queue.prepare(update_message))
 
     def send_server_awareness(self, type: str, changes: tuple[dict[str, Any], Any]) -> None:
         """
@@ -345,14 +707,86 @@ class YRoom:
         else:
             self.log.error("Cannot broadcast server awareness: YRoom not started")
 
+    def _track_awareness(
+        self, websocket: Websocket, update: bytes
+    ) -> list[tuple[int, int, bytes]]:
+        # track the clients of a WebSocket from their clocks only,
+        # and return the entries that are newer than the ones already received
+        entries = []
+        client_ids = self._client_awareness_ids.setdefault(websocket, set())
+        for client_id, clock, state in read_awareness_update(update):
+            removed = state in (b"", b"null")
+            current_clock = self._awareness_clocks.get(client_id)
+            if current_clock is not None and (
+                clock < current_clock or (clock == current_clock and not removed)
+            ):
+                continue
+            if removed:
+                self._awareness_clocks.pop(client_id, None)
+                self._pending_awareness_entries.pop(client_id, None)
+                client_ids.discard(client_id)
+            else:
+                self._awareness_clocks[client_id] = clock
+                client_ids.add(client_id)
+            entries.append((client_id, clock, state))
+        return entries
+
+    def _remove_client_awareness(self, websocket: Websocket) -> None:
+        # broadcast the removal of the clients of a WebSocket that closed
+        # without sending a disconnection message
+        client_ids = self._client_awareness_ids.pop(websocket, set())
+        entries = []
+        for client_id in client_ids:
+            self._pending_awareness_entries.pop(client_id, None)
+            clock = self._awareness_clocks.pop(client_id, None)
+            if clock is not None:
+                entries.append((client_id, clock + 1, b"null"))
+        if entries and self._task_group is not None:
+            message = create_awareness_message(write_awareness_update(entries))
+            self._task_group.start_soon(self._send_server_awareness, message)
+
+    def _collect_awareness(self, type: str, changes: tuple[dict[str, Any], Any]) -> None:
+        # remember the clients whose state changed through a message from a client,
+        # removals are not collected since disconnections are broadcast right away
+        if (
+            type != "update"
+            or changes[1] is not self
+            or self.awareness_flush_interval is None
+            or not (changes[0]["added"] or changes[0]["updated"])
+        ):
+            return
+        self._pending_awareness.update(changes[0]["added"], changes[0]["updated"])
+        self._awareness_pending.set()
+
+    async def _flush_awareness(self) -> None:
+        assert self.awareness_flush_interval is not None
+        while True:
+            await self._awareness_pending.wait()
+            await sleep(self.awareness_flush_interval)
+            self._awareness_pending = Event()
+            if self.lightweight_awareness:
+                entries = self._pending_awareness_entries
+                self._pending_awareness_entries = {}
+                if not entries:
+                    continue
+                state = write_awareness_update(
+                    (client_id, clock, client_state)
+                    for client_id, (clock, client_state) in entries.items()
+                )
+            else:
+                client_ids = list(self._pending_awareness)
+                self._pending_awareness.clear()
+                state = self.awareness.encode_awareness_update(client_ids)
+            await self._send_server_awareness(create_awareness_message(state))
+
     async def _send_server_awareness(self, state: bytes) -> None:
         try:
-            async with create_task_group() as tg:
-                for client in self.clients:
-                    self.log.debug(
-                        "Sending awareness from server to client with endpoint: %s",
-                        client.path,
-                    )
-                    tg.start_soon(client.send, state)
+            frames: dict[type, Any] = {}
+            for client in list(self.clients):
+                self.log.debug(
+                    "Sending awareness from server to client with endpoint: %s",
+                    client.path,
+                )
+                await self._send(client, state, frames)
         except Exception as e:
             self.log.error("Error while broadcasting awareness changes: %s", e)
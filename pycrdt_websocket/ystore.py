@@ -1,32 +1,120 @@
 from __future__ import annotations
 
+import mmap
+import os
 import struct
 import tempfile
 import time
 from abc import ABC, abstractmethod
-from contextlib import AsyncExitStack
+from contextlib import AsyncExitStack, asynccontextmanager
 from functools import partial
 from inspect import isawaitable
 from logging import Logger, getLogger
 from pathlib import Path
-from typing import AsyncIterator, Awaitable, Callable, cast
+from typing import AsyncIterator, Awaitable, Callable, Generator, cast
 
 import anyio
-from anyio import TASK_STATUS_IGNORED, Event, Lock, create_task_group
+from anyio import (
+    TASK_STATUS_IGNORED,
+    AsyncFile,
+    CapacityLimiter,
+    Event,
+    Lock,
+    create_memory_object_stream,
+    create_task_group,
+    move_on_after,
+    sleep,
+    to_thread,
+)
 from anyio.abc import TaskGroup, TaskStatus
-from pycrdt import Decoder, Doc, write_var_uint
+from anyio.streams.memory import MemoryObjectReceiveStream, MemoryObjectSendStream
+from pycrdt import Decoder, Doc, merge_updates, write_var_uint
 from sqlite_anyio import Connection, connect, exception_logger
 
-from .yutils import get_new_path
+from .yutils import get_new_path, run_sync
+
+# the kinds of FileYStore records
+_DELTA = b"\x00"
+_SNAPSHOT = b"\x01"
+
+
+def _read_record(data: memoryview, offset: int) -> tuple[list[memoryview], int]:
+    # read the (kind, update, metadata, timestamp) fields of a FileYStore record,
+    # each of them prefixed with its length as a variable-length unsigned integer
+    fields = []
+    for _ in range(4):
+        length = shift = 0
+        while True:
+            byte = data[offset]
+            offset += 1
+            length |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+        fields.append(data[offset : offset + length])
+        offset += length
+    return fields, offset
+
+
+def _squash_updates(updates: list[bytes]) -> bytes:
+    # apply the updates to a new document, which can be done in a worker process
+    # since the document is only used there
+    ydoc: Doc = Doc()
+    for update in updates:
+        ydoc.apply_update(update)
+    return ydoc.get_update()
 
 
 class YDocNotFound(Exception):
     pass
 
 
+class YStoreCursor:
+    """An opaque position in the history of a document, right after an update read with
+    `read_with_cursor()`. Unlike the timestamp of the update, it tells apart the updates
+    written with the same timestamp, so that passing it back as `since` reads exactly the
+    updates written after this one.
+    """
+
+    timestamp: float
+    _position: int | None
+
+    def __init__(self, timestamp: float, position: int | None = None) -> None:
+        self.timestamp = timestamp
+        self._position = position
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, YStoreCursor):
+            return NotImplemented
+        return (self.timestamp, self._position) == (other.timestamp, other._position)
+
+    def __repr__(self) -> str:
+        return f"YStoreCursor({self.timestamp!r}, {self._position!r})"
+
+
 class BaseYStore(ABC):
     metadata_callback: Callable[[], Awaitable[bytes] | bytes] | None = None
     version = 2
+    # Enables background compaction, i.e. squashing the history of a document into a single
+    # update once more than "compaction_max_updates" updates or "compaction_max_bytes" bytes
+    # have been written since it was last squashed. Defaults to never compacting (None).
+    compaction_max_updates: int | None = None
+    compaction_max_bytes: int | None = None
+    # Determines the minimum delay (in seconds) between two compactions, across all documents.
+    compaction_interval: float = 1
+    # Determines the number of updates merged at once when reading the document as a single
+    # update, which bounds the number of updates held in memory.
+    merge_chunk_size: int = 1000
+    # Determines the size (in bytes) of the updates from which merging or squashing them is
+    # done in a worker process, so that it doesn't block the event loop.
+    # Defaults to always doing it in the event loop thread (None).
+    offload_threshold: int | None = None
+    # An optional capacity limiter for these worker processes, e.g. shared by all the stores.
+    # Defaults to the default limiter of AnyIO (None).
+    offload_limiter: CapacityLimiter | None = None
+    log: Logger
+    _next_compaction_time: float = 0
+    _compaction_scheduled: bool = False
     _started: Event | None = None
     _stopped: Event | None = None
     _task_group: TaskGroup | None = None
@@ -42,10 +130,39 @@ class BaseYStore(ABC):
     async def write(self, data: bytes) -> None: ...
 
     @abstractmethod
-    async def read(self) -> AsyncIterator[tuple[bytes, bytes, float]]:
+    async def read(
+        self,
+        since: float | YStoreCursor | None = None,
+        until: float | None = None,
+        limit: int | None = None,
+    ) -> AsyncIterator[tuple[bytes, bytes, float]]:
         if False:
             yield
 
+    async def read_with_cursor(
+        self,
+        since: float | YStoreCursor | None = None,
+        until: float | None = None,
+        limit: int | None = None,
+    ) -> AsyncIterator[tuple[bytes, bytes, float, YStoreCursor]]:
+        """Async iterator for reading the document history like `read()`, which also returns
+        a cursor after each update, to pass back as `since` to read the next updates.
+
+        Arguments:
+            since: The time after which the updates were written, or the cursor of the last
+                update already read.
+            until: The time until which the updates were written.
+            limit: The maximum number of updates to read.
+
+        Returns:
+            A tuple of (update, metadata, timestamp, cursor) for each update.
+        """
+        if isinstance(since, YStoreCursor):
+            # stores which don't support cursors only use their timestamp
+            since = since.timestamp
+        async for update, metadata, timestamp in self.read(since, until, limit):
+            yield update, metadata, timestamp, YStoreCursor(timestamp)
+
     @property
     def started(self) -> Event:
         if self._started is None:
@@ -121,6 +238,48 @@ class BaseYStore(ABC):
         self._task_group.cancel_scope.cancel()
         self._task_group = None
 
+    async def flush(self) -> None:
+        """Write the pending updates to the store, if any."""
+
+    async def compact(self) -> None:
+        """Squash the history of the document into a single update.
+        Updates written while the history is being squashed are kept after it.
+        Stores which don't support it don't do anything.
+        """
+
+    def _maybe_compact(self, update_count: int, byte_count: int) -> None:
+        """Schedule a background compaction if too many updates were written since the
+        document history was last squashed.
+
+        Arguments:
+            update_count: The number of updates written since the history was last squashed.
+            byte_count: The size of these updates, in bytes.
+        """
+        if self._compaction_scheduled or self._task_group is None:
+            return
+        if type(self).compact is BaseYStore.compact:
+            # the store doesn't support compaction
+            return
+        if (
+            self.compaction_max_updates is None or update_count <= self.compaction_max_updates
+        ) and (self.compaction_max_bytes is None or byte_count <= self.compaction_max_bytes):
+            return
+        self._compaction_scheduled = True
+        self._task_group.start_soon(self._compact_in_background)
+
+    async def _compact_in_background(self) -> None:
+        try:
+            # compactions of all documents are spaced out by the compaction interval
+            now = time.monotonic()
+            compaction_time = max(now, BaseYStore._next_compaction_time)
+            BaseYStore._next_compaction_time = compaction_time + self.compaction_interval
+            await sleep(compaction_time - now)
+            await self.compact()
+        except Exception as exception:
+            self.log.error("Error while compacting document history", exc_info=exception)
+        finally:
+            self._compaction_scheduled = False
+
     async def get_metadata(self) -> bytes:
         """
         Returns:
@@ -144,22 +303,88 @@ class BaseYStore(ABC):
         update = ydoc.get_update()
         await self.write(update)
 
+    async def read_update(self) -> bytes:
+        """Read the store content as a single update, merging the stored updates
+        as they are read.
+
+        Returns:
+            The merged update.
+        """
+        # the updates are merged by chunks, and the merged chunks are merged in turn once
+        # there are enough of them, so that each update is merged only a few times
+        levels: list[list[bytes]] = [[]]
+        async for update, *rest in self.read():
+            levels[0].append(update)
+            level = 0
+            while len(levels[level]) >= self.merge_chunk_size:
+                if level + 1 == len(levels):
+                    levels.append([])
+                levels[level + 1].append(await self._merge_updates(levels[level]))
+                levels[level] = []
+                level += 1
+        updates = [update for level_updates in reversed(levels) for update in level_updates]
+        return await self._merge_updates(updates)
+
+    async def _merge_updates(self, updates: list[bytes]) -> bytes:
+        """Merge updates, in a worker process if they are larger than `offload_threshold`.
+
+        Arguments:
+            updates: The updates to merge.
+
+        Returns:
+            The merged update.
+        """
+        if len(updates) == 1:
+            return updates[0]
+        size = sum(len(update) for update in updates)
+        return await run_sync(
+            merge_updates,
+            *updates,
+            size=size,
+            threshold=self.offload_threshold,
+            limiter=self.offload_limiter,
+        )
+
     async def apply_updates(self, ydoc: Doc) -> None:
-        """Apply all stored updates to the YDoc.
+        """Apply all stored updates to the YDoc, as a single update.
 
         Arguments:
             ydoc: The YDoc on which to apply the updates.
         """
-        async for update, *rest in self.read():
-            ydoc.apply_update(update)
+        ydoc.apply_update(await self.read_update())
 
 
 class FileYStore(BaseYStore):
-    """A YStore which uses one file per document."""
+    """A YStore which uses one file per document.
+
+    The file starts with a header consisting of the version of the store format and of an
+    index pointing to the snapshot of the document (its history squashed into a single update,
+    once it is compacted), and to the updates that are not part of the snapshot. Loading a
+    document only reads the snapshot and these updates.
+    """
 
+    version = 3
+    # Enables group commit, i.e. the file is synced to disk at most every "fsync_interval"
+    # seconds after updates have been written to it, while the store is running.
+    # Defaults to leaving it to the operating system (None).
+    fsync_interval: float | None = None
     path: str
     metadata_callback: Callable[[], Awaitable[bytes] | bytes] | None
     lock: Lock
+    # the number of updates and their size written since the store was created or since the
+    # snapshot of the document was taken, which don't count the snapshot itself
+    _update_count: int
+    _byte_count: int
+    # the offsets of the latest snapshot (0 if none) and of the updates not in the snapshot
+    _index = struct.Struct("<QQ")
+    # the file opened for appending updates while the store is running, and the offset where
+    # the data is located in it, once the version of the store format has been checked
+    _file: AsyncFile[bytes] | None
+    _offset: int | None
+    # set when the file needs to be synced to disk, while the store is running
+    _sync_needed: Event | None
+    # the entries of the sidecar index of the delta records: their timestamp and offset
+    _index_entry = struct.Struct("<dQ")
 
     def __init__(
         self,
@@ -178,9 +403,86 @@ class FileYStore(BaseYStore):
         self.metadata_callback = metadata_callback
         self.log = log or getLogger(__name__)
         self.lock = Lock()
+        self._update_count = 0
+        self._byte_count = 0
+        self._file = None
+        self._offset = None
+        self._sync_needed = None
+        self._index_path = f"{path}.idx"
+
+    async def start(
+        self,
+        *,
+        task_status: TaskStatus[None] = TASK_STATUS_IGNORED,
+        from_context_manager: bool = False,
+    ):
+        """Start the FileYStore.
+
+        Arguments:
+            task_status: The status to set when the task has started.
+        """
+        self._sync_needed = Event()
+        if from_context_manager:
+            assert self._task_group is not None
+            async with self.lock:
+                self._file = await self._open_file()
+            if self.fsync_interval is not None:
+                self._task_group.start_soon(self._sync_periodically)
+            task_status.started()
+            self.started.set()
+            return
+
+        async with self._start_lock:
+            if self._task_group is not None:
+                raise RuntimeError("YStore already running")
+            async with self.lock:
+                self._file = await self._open_file()
+            async with create_task_group() as self._task_group:
+                if self.fsync_interval is not None:
+                    self._task_group.start_soon(self._sync_periodically)
+                task_status.started()
+                self.started.set()
+                await self.stopped.wait()
+
+    async def stop(self) -> None:
+        """Stop the store."""
+        async with self.lock:
+            if self._file is not None:
+                if self._sync_needed is not None and self._sync_needed.is_set():
+                    await to_thread.run_sync(os.fsync, self._file.wrapped.fileno())
+                await self._file.aclose()
+                self._file = None
+            self._offset = None
+            self._sync_needed = None
+        await super().stop()
+
+    async def _open_file(self) -> AsyncFile[bytes]:
+        # must be called with the lock acquired
+        await anyio.Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        await self._get_offset()
+        # unbuffered, so that each record is written with a single system call
+        return await anyio.open_file(self.path, "ab", buffering=0)
+
+    async def _get_offset(self) -> int:
+        # must be called with the lock acquired
+        if self._offset is None:
+            self._offset = await self.check_version()
+        return self._offset
+
+    async def _sync_periodically(self) -> None:
+        assert self.fsync_interval is not None
+        while True:
+            assert self._sync_needed is not None
+            await self._sync_needed.wait()
+            await sleep(self.fsync_interval)
+            self._sync_needed = Event()
+            async with self.lock:
+                if self._file is not None:
+                    await to_thread.run_sync(os.fsync, self._file.wrapped.fileno())
 
     async def check_version(self) -> int:
-        """Check the version of the store format.
+        """Check the version of the store format, and migrate the file from the previous
+        version if needed.
 
         Returns:
             The offset where the data is located in the file.
@@ -190,12 +492,15 @@ class FileYStore(BaseYStore):
         else:
             version_mismatch = False
             move_file = False
+            migrate_file = False
             async with await anyio.open_file(self.path, "rb") as f:
                 header = await f.read(8)
                 if header == b"VERSION:":
                     version = int(await f.readline())
                     if version == self.version:
-                        offset = await f.tell()
+                        offset = await f.tell() + self._index.size
+                    elif version == 2 and self.version == 3:
+                        migrate_file = True
                     else:
                         version_mismatch = True
                 else:
@@ -206,38 +511,388 @@ class FileYStore(BaseYStore):
                 new_path = await get_new_path(self.path)
                 self.log.warning("YStore version mismatch, moving %s to %s", self.path, new_path)
                 await anyio.Path(self.path).rename(new_path)
+            if migrate_file:
+                offset = await self._migrate_from_version_2()
+        if version_mismatch or migrate_file:
+            await anyio.Path(self._index_path).unlink(missing_ok=True)
         if version_mismatch:
             async with await anyio.open_file(self.path, "wb") as f:
-                version_bytes = f"VERSION:{self.version}\n".encode()
-                await f.write(version_bytes)
-                offset = len(version_bytes)
+                header = self._encode_header()
+                await f.write(header)
+                offset = len(header)
         return offset
 
-    async def read(self) -> AsyncIterator[tuple[bytes, bytes, float]]:
-        """Async iterator for reading the store content.
+    async def _migrate_from_version_2(self) -> int:
+        self.log.info("Migrating YStore %s to version %s", self.path, self.version)
+        async with await anyio.open_file(self.path, "rb") as f:
+            await f.readline()
+            data = await f.read()
+        header = self._encode_header()
+        migrated_path = f"{self.path}.migrated"
+        async with await anyio.open_file(migrated_path, "wb") as f:
+            await f.write(header)
+            messages = Decoder(data).read_messages()
+            for update, metadata, timestamp in zip(messages, messages, messages):
+                record = self._encode_record(
+                    _DELTA, update, metadata, struct.unpack("<d", timestamp)[0]
+                )
+                await f.write(record)
+        await anyio.Path(migrated_path).replace(self.path)
+        return len(header)
+
+    def _encode_header(self, snapshot_offset: int = 0, tail_offset: int | None = None) -> bytes:
+        version = f"VERSION:{self.version}\n".encode()
+        if tail_offset is None:
+            tail_offset = len(version) + self._index.size
+        return version + self._index.pack(snapshot_offset, tail_offset)
+
+    def _encode_record(
+        self, kind: bytes, update: bytes, metadata: bytes, timestamp: float
+    ) -> bytes:
+        timestamp_bytes = struct.pack("<d", timestamp)
+        return b"".join(
+            write_var_uint(len(d)) + d for d in (kind, update, metadata, timestamp_bytes)
+        )
+
+    def _map_file(self) -> mmap.mmap | None:
+        with open(self.path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return None
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    async def _map_latest(self) -> tuple[mmap.mmap, int, int] | None:
+        # must be called with the lock acquired
+        offset = await self._get_offset()
+        data = await to_thread.run_sync(self._map_file)
+        if data is None:
+            return None
+        snapshot_offset, tail_offset = self._index.unpack_from(data, offset - self._index.size)
+        return data, snapshot_offset, tail_offset
+
+    def _decode_records(
+        self, data: mmap.mmap, offset: int, kind: bytes = _DELTA
+    ) -> Generator[tuple[bytes, bytes, float], None, None]:
+        # the records are decoded from a view of the mapped file,
+        # only the updates and metadata of the given kind of records are copied
+        view = memoryview(data)
+        while offset < len(view):
+            record, offset = _read_record(view, offset)
+            record_kind, update, metadata, timestamp = record
+            if record_kind == kind:
+                yield update.tobytes(), metadata.tobytes(), struct.unpack("<d", timestamp)[0]
+
+    def _decode_snapshot(self, data: mmap.mmap, offset: int) -> tuple[bytes, bytes, float]:
+        records = self._decode_records(data, offset, _SNAPSHOT)
+        try:
+            return next(records)
+        finally:
+            records.close()
+
+    def _update_index(self, data: mmap.mmap, offset: int) -> None:
+        # add the delta records that are not indexed yet to the index,
+        # which is rebuilt if it doesn't match the file
+        entry_size = self._index_entry.size
+        view = memoryview(data)
+        with open(self._index_path, "a+b") as f:
+            size = f.seek(0, os.SEEK_END)
+            if size:
+                valid = False
+                if size % entry_size == 0:
+                    f.seek(size - entry_size)
+                    timestamp, record_offset = self._index_entry.unpack(f.read(entry_size))
+                    if offset <= record_offset < len(view):
+                        try:
+                            record, end = _read_record(view, record_offset)
+                        except (IndexError, struct.error):
+                            pass
+                        else:
+                            valid = (
+                                record[0] == _DELTA
+                                and struct.unpack("<d", record[3])[0] == timestamp
+                            )
+                if valid:
+                    offset = end
+                else:
+                    self.log.warning("YStore index mismatch, rebuilding %s", self._index_path)
+                    f.truncate(0)
+            entries = []
+            while offset < len(view):
+                record_offset = offset
+                record, offset = _read_record(view, offset)
+                if record[0] == _DELTA:
+                    timestamp = struct.unpack("<d", record[3])[0]
+                    entries.append(self._index_entry.pack(timestamp, record_offset))
+            f.write(b"".join(entries))
+
+    def _find_record(
+        self, since: float | YStoreCursor | None, last: int | None
+    ) -> tuple[int, int] | None:
+        # find the offset of the first delta record written after the given position,
+        # or of the given number of latest delta records, using the index,
+        # and the number of delta records before it with the same timestamp
+        entry = self._index_entry
+        with open(self._index_path, "rb") as f:
+            count = os.fstat(f.fileno()).st_size // entry.size
+            if count == 0:
+                return None
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as entries:
+
+                def timestamp_at(position: int) -> float:
+                    return entry.unpack_from(entries, position * entry.size)[0]
+
+                def bisect(timestamp: float, after: bool) -> int:
+                    # the position of the first entry with a timestamp greater than
+                    # (or equal to, if not after) the given one
+                    low, high = 0, count
+                    while low < high:
+                        middle = (low + high) // 2
+                        middle_timestamp = timestamp_at(middle)
+                        if middle_timestamp < timestamp or (
+                            after and middle_timestamp == timestamp
+                        ):
+                            low = middle + 1
+                        else:
+                            high = middle
+                    return low
+
+                if last is not None:
+                    position = max(count - last, 0)
+                elif since is None:
+                    position = 0
+                elif isinstance(since, YStoreCursor) and since._position is not None:
+                    # the position of a cursor is the rank of its record
+                    # among the records with the same timestamp
+                    position = min(
+                        bisect(since.timestamp, False) + since._position,
+                        bisect(since.timestamp, True),
+                    )
+                else:
+                    if isinstance(since, YStoreCursor):
+                        since = since.timestamp
+                    position = bisect(since, True)
+                if position == count:
+                    return None
+                rank = position - bisect(timestamp_at(position), False)
+                return entry.unpack_from(entries, position * entry.size)[1], rank
+
+    async def read(
+        self,
+        since: float | YStoreCursor | None = None,
+        until: float | None = None,
+        limit: int | None = None,
+    ) -> AsyncIterator[tuple[bytes, bytes, float]]:
+        """Async iterator for reading the store content. By default, it starts with the latest
+        snapshot of the document (if any), followed by the updates written after it.
+        Otherwise, the updates in the given time range are read from the document history,
+        in the order they were written, using the index to find the first one. Since the
+        history squashed in the snapshot is not kept, the range starts with the snapshot if
+        it starts before it.
+
+        Arguments:
+            since: The time after which the updates were written, or the cursor of the last
+                update already read (see `read_with_cursor()`).
+            until: The time until which the updates were written.
+            limit: The maximum number of updates to read.
 
         Returns:
             A tuple of (update, metadata, timestamp) for each update.
         """
+        if since is not None or until is not None or limit is not None:
+            async for update, metadata, timestamp, _ in self._read_indexed(since, until, limit):
+                yield update, metadata, timestamp
+            return
+
         async with self.lock:
             if not await anyio.Path(self.path).exists():
                 raise YDocNotFound
-            offset = await self.check_version()
+            latest = await self._map_latest()
+        if latest is None:
+            raise YDocNotFound
+        data, snapshot_offset, tail_offset = latest
+        try:
+            if not snapshot_offset and tail_offset >= len(data):
+                raise YDocNotFound
+            if snapshot_offset:
+                yield self._decode_snapshot(data, snapshot_offset)
+            records = self._decode_records(data, tail_offset)
+            try:
+                for record in records:
+                    yield record
+            finally:
+                records.close()
+        finally:
+            data.close()
+
+    async def read_last(self, count: int) -> AsyncIterator[tuple[bytes, bytes, float]]:
+        """Async iterator for reading the latest updates,
+        without reading the updates written before them.
+
+        Arguments:
+            count: The number of updates to read.
+
+        Returns:
+            A tuple of (update, metadata, timestamp) for each update.
+        """
+        async for update, metadata, timestamp, _ in self._read_indexed(last=count):
+            yield update, metadata, timestamp
+
+    async def read_with_cursor(
+        self,
+        since: float | YStoreCursor | None = None,
+        until: float | None = None,
+        limit: int | None = None,
+    ) -> AsyncIterator[tuple[bytes, bytes, float, YStoreCursor]]:
+        """Async iterator for reading the updates of the document history in the order they
+        were written, starting with the snapshot if the range starts before it, which also
+        returns a cursor after each update, to pass back as `since` to read the next updates.
+
+        Arguments:
+            since: The time after which the updates were written, or the cursor of the last
+                update already read.
+            until: The time until which the updates were written.
+            limit: The maximum number of updates to read.
+
+        Returns:
+            A tuple of (update, metadata, timestamp, cursor) for each update.
+        """
+        async for record in self._read_indexed(since, until, limit):
+            yield record
+
+    async def _read_indexed(
+        self,
+        since: float | YStoreCursor | None = None,
+        until: float | None = None,
+        limit: int | None = None,
+        last: int | None = None,
+    ) -> AsyncIterator[tuple[bytes, bytes, float, YStoreCursor]]:
+        async with self.lock:
+            if not await anyio.Path(self.path).exists():
+                raise YDocNotFound
+            offset = await self._get_offset()
+            data = await to_thread.run_sync(self._map_file)
+            if data is None:
+                raise YDocNotFound
+            try:
+                await to_thread.run_sync(self._update_index, data, offset)
+                found = await to_thread.run_sync(self._find_record, since, last)
+            except BaseException:
+                data.close()
+                raise
+        try:
+            count = 0
+            if last is None and limit != 0:
+                snapshot = self._read_snapshot(data, offset, since, until)
+                if snapshot is not None:
+                    count += 1
+                    yield snapshot
+            if found is not None and count != limit:
+                record_offset, rank = found
+                records = self._decode_records(data, record_offset)
+                try:
+                    last_timestamp = None
+                    for count, (update, metadata, timestamp) in enumerate(records, count + 1):
+                        if until is not None and timestamp > until:
+                            break
+                        if timestamp == last_timestamp or last_timestamp is None:
+                            rank += 1
+                        else:
+                            rank = 1
+                        last_timestamp = timestamp
+                        yield update, metadata, timestamp, YStoreCursor(timestamp, rank)
+                        if count == limit:
+                            break
+                finally:
+                    records.close()
+        finally:
+            data.close()
+
+    def _read_snapshot(
+        self,
+        data: mmap.mmap,
+        offset: int,
+        since: float | YStoreCursor | None,
+        until: float | None,
+    ) -> tuple[bytes, bytes, float, YStoreCursor] | None:
+        # the snapshot is read if the range starts before it, i.e. before the timestamp
+        # of the latest update squashed in it, since the history before it is not kept
+        snapshot_offset = self._index.unpack_from(data, offset - self._index.size)[0]
+        if not snapshot_offset:
+            return None
+        update, metadata, timestamp = self._decode_snapshot(data, snapshot_offset)
+        if until is not None and timestamp > until:
+            return None
+        if isinstance(since, YStoreCursor) and since._position is not None:
+            # the cursor of the snapshot has a rank of 0, the cursor of an update
+            # with the same timestamp may not have been squashed in it
+            if since.timestamp > timestamp or (
+                since.timestamp == timestamp and since._position == 0
+            ):
+                return None
+        elif isinstance(since, YStoreCursor):
+            if since.timestamp >= timestamp:
+                return None
+        elif since is not None and since >= timestamp:
+            return None
+        return update, metadata, timestamp, YStoreCursor(timestamp, 0)
+
+    async def compact(self) -> None:
+        """Squash the history of the document into a snapshot.
+        The file is rewritten with the snapshot, followed by the updates written while the
+        history was being squashed, so the squashed updates can't be read anymore.
+        """
+        async with self.lock:
+            if not await anyio.Path(self.path).exists():
+                return
+            latest = await self._map_latest()
+            # the updates written so far are squashed
+            update_count, byte_count = self._update_count, self._byte_count
+        if latest is None:
+            return
+        data, snapshot_offset, tail_offset = latest
+        try:
+            updates = []
+            if snapshot_offset:
+                updates.append(self._decode_snapshot(data, snapshot_offset)[0])
+            for update, _, timestamp in self._decode_records(data, tail_offset):
+                updates.append(update)
+            # the updates written while squashing are not in the snapshot
+            squashed_offset = len(data)
+        finally:
+            data.close()
+        if len(updates) < 2:
+            # the history is already squashed
+            self._update_count -= update_count
+            self._byte_count -= byte_count
+            return
+        # the history is squashed without holding the lock, so that writes can go on
+        squashed_update = await self._merge_updates(updates)
+        metadata = await self.get_metadata()
+        snapshot = self._encode_record(_SNAPSHOT, squashed_update, metadata, timestamp)
+        compacted_path = f"{self.path}.compacted"
+        async with self.lock:
+            offset = await self._get_offset()
             async with await anyio.open_file(self.path, "rb") as f:
-                await f.seek(offset)
-                data = await f.read()
-                if not data:
-                    raise YDocNotFound
-        i = 0
-        for d in Decoder(data).read_messages():
-            if i == 0:
-                update = d
-            elif i == 1:
-                metadata = d
-            else:
-                timestamp = struct.unpack("<d", d)[0]
-                yield update, metadata, timestamp
-            i = (i + 1) % 3
+                await f.seek(squashed_offset)
+                tail = await f.read()
+            async with await anyio.open_file(compacted_path, "wb") as f:
+                await f.write(self._encode_header(offset, offset + len(snapshot)))
+                await f.write(snapshot)
+                await f.write(tail)
+                await f.flush()
+                await to_thread.run_sync(os.fsync, f.wrapped.fileno())
+            # the file opened for appending must be reopened once the file is replaced
+            reopen_file = self._file is not None
+            if self._file is not None:
+                await self._file.aclose()
+                self._file = None
+            await anyio.Path(compacted_path).replace(self.path)
+            # the index of the delta records is rebuilt on first use
+            await anyio.Path(self._index_path).unlink(missing_ok=True)
+            if reopen_file:
+                self._file = await self._open_file()
+            # only the updates written while squashing are left to count
+            self._update_count -= update_count
+            self._byte_count -= byte_count
 
     async def write(self, data: bytes) -> None:
         """Store an update.
@@ -245,19 +900,20 @@ class FileYStore(BaseYStore):
         Arguments:
             data: The update to store.
         """
-        parent = Path(self.path).parent
         async with self.lock:
-            await anyio.Path(parent).mkdir(parents=True, exist_ok=True)
-            await self.check_version()
-            async with await anyio.open_file(self.path, "ab") as f:
-                data_len = write_var_uint(len(data))
-                await f.write(data_len + data)
-                metadata = await self.get_metadata()
-                metadata_len = write_var_uint(len(metadata))
-                await f.write(metadata_len + metadata)
-                timestamp = struct.pack("<d", time.time())
-                timestamp_len = write_var_uint(len(timestamp))
-                await f.write(timestamp_len + timestamp)
+            metadata = await self.get_metadata()
+            record = self._encode_record(_DELTA, data, metadata, time.time())
+            if self._file is not None:
+                await self._file.write(record)
+            else:
+                # the store is not running, so the file is only opened for this update
+                async with await self._open_file() as f:
+                    await f.write(record)
+            self._update_count += 1
+            self._byte_count += len(data)
+            self._maybe_compact(self._update_count, self._byte_count)
+        if self.fsync_interval is not None and self._sync_needed is not None:
+            self._sync_needed.set()
 
 
 class TempFileYStore(FileYStore):
@@ -306,6 +962,33 @@ class TempFileYStore(FileYStore):
         type(self).base_dir = tempfile.mkdtemp(prefix=self.prefix_dir)
 
 
+class _Flush:
+    # the completion of a flush of the pending updates, and its exception if it failed
+    done: Event
+    exception: BaseException | None
+
+    def __init__(self) -> None:
+        self.done = Event()
+        self.exception = None
+
+
+class _ReadPool:
+    # the read-only connections to a database, shared by the stores using it
+    connections: list[Connection]
+    send_stream: MemoryObjectSendStream[Connection]
+    receive_stream: MemoryObjectReceiveStream[Connection]
+    # set once the connections are opened
+    ready: Event
+    # the number of stores using the pool
+    users: int
+
+    def __init__(self, size: int) -> None:
+        self.connections = []
+        self.send_stream, self.receive_stream = create_memory_object_stream(max_buffer_size=size)
+        self.ready = Event()
+        self.users = 1
+
+
 class SQLiteYStore(BaseYStore):
     """A YStore which uses an SQLite database.
     Unlike file-based YStores, the Y updates of all documents are stored in the same database.
@@ -323,10 +1006,44 @@ class SQLiteYStore(BaseYStore):
     # latest update of a document must be before purging document history.
     # Defaults to never purging document history (None).
     document_ttl: int | None = None
+    # Enables write-behind, i.e. updates are queued in memory and written to the database
+    # in batches, at most every "flush_delay" seconds or every "flush_max_updates" updates.
+    # Defaults to writing each update to the database right away (None).
+    flush_delay: float | None = None
+    flush_max_updates: int = 1000
+    # Determines whether writing an update waits until it is committed to the database,
+    # when write-behind is enabled. Otherwise, pending updates are lost if the process crashes.
+    flush_wait: bool = False
+    # SQLite pragmas set on the database connections, for instance:
+    # {"journal_mode": "wal", "synchronous": "normal", "mmap_size": 268435456}
+    # Defaults to SQLite's defaults (None).
+    pragmas: dict[str, str | int] | None = None
+    # Determines the number of read-only connections used to read the documents,
+    # so that reading doesn't wait for writes (best used with the "wal" journal mode).
+    # The connections are shared by all the stores using the same database file, and are
+    # opened by the first of them to start. Defaults to reading through the write
+    # connection of each store (0).
+    read_pool_size: int = 0
+    # Determines the number of updates fetched at once when reading the document.
+    read_chunk_size: int = 1000
     path: str
     lock: Lock
     db_initialized: Event | None
     _db: Connection
+    _pending_updates: list[tuple[str, bytes, bytes, float]]
+    # the number of updates and their size written to the document since its history was
+    # last squashed, and the timestamp of its latest update in the database, loaded on the
+    # first write and then kept up-to-date, assuming that this store is the only one writing
+    # to this document
+    _update_count: int | None
+    _byte_count: int
+    _last_timestamp: float | None
+    _flush_needed: Event
+    _flush_now: Event
+    _flushed: _Flush
+    # the read pools of the running stores, by database file
+    _read_pools: dict[str, _ReadPool] = {}
+    _read_pool: _ReadPool | None
 
     def __init__(
         self,
@@ -346,6 +1063,11 @@ class SQLiteYStore(BaseYStore):
         self.log = log or getLogger(__name__)
         self.lock = Lock()
         self.db_initialized = None
+        self._pending_updates = []
+        self._update_count = None
+        self._byte_count = 0
+        self._last_timestamp = None
+        self._read_pool = None
 
     async def start(
         self,
@@ -359,9 +1081,12 @@ class SQLiteYStore(BaseYStore):
             task_status: The status to set when the task has started.
         """
         self.db_initialized = Event()
+        self._flushed, self._flush_needed, self._flush_now = _Flush(), Event(), Event()
         if from_context_manager:
             assert self._task_group is not None
             self._task_group.start_soon(self._init_db)
+            if self.flush_delay is not None:
+                self._task_group.start_soon(self._flush_periodically)
             task_status.started()
             self.started.set()
             return
@@ -371,6 +1096,8 @@ class SQLiteYStore(BaseYStore):
                 raise RuntimeError("YStore already running")
             async with create_task_group() as self._task_group:
                 self._task_group.start_soon(self._init_db)
+                if self.flush_delay is not None:
+                    self._task_group.start_soon(self._flush_periodically)
                 task_status.started()
                 self.started.set()
                 await self.stopped.wait()
@@ -378,7 +1105,11 @@ class SQLiteYStore(BaseYStore):
     async def stop(self) -> None:
         """Stop the store."""
         if self.db_initialized is not None and self.db_initialized.is_set():
+            await self.flush()
             await self._db.close()
+            if self._read_pool is not None:
+                await self._release_read_pool(self._read_pool)
+                self._read_pool = None
         await super().stop()
 
     async def _init_db(self):
@@ -431,40 +1162,223 @@ class SQLiteYStore(BaseYStore):
                     )
                     await cursor.execute(f"PRAGMA user_version = {self.version}")
                 await db.close()
-        self._db = await connect(
+        self._db = await self._connect()
+        if self.read_pool_size:
+            self._read_pool = await self._acquire_read_pool()
+        assert self.db_initialized is not None
+        self.db_initialized.set()
+
+    async def _connect(self, read_only: bool = False) -> Connection:
+        db = await connect(
             self.db_path,
             exception_handler=exception_logger,
             log=self.log,
         )
-        assert self.db_initialized is not None
-        self.db_initialized.set()
+        pragmas = dict(self.pragmas or {})
+        if read_only:
+            pragmas["query_only"] = "on"
+        cursor = await db.cursor()
+        for name, value in pragmas.items():
+            await cursor.execute(f"PRAGMA {name} = {value}")
+        return db
+
+    async def _acquire_read_pool(self) -> _ReadPool:
+        pool = SQLiteYStore._read_pools.get(self.db_path)
+        if pool is not None:
+            pool.users += 1
+            await pool.ready.wait()
+            return pool
+
+        pool = SQLiteYStore._read_pools[self.db_path] = _ReadPool(self.read_pool_size)
+        try:
+            for _ in range(self.read_pool_size):
+                db = await self._connect(read_only=True)
+                pool.connections.append(db)
+                pool.send_stream.send_nowait(db)
+        except BaseException:
+            # the stores waiting for the pool read through their write connection
+            del SQLiteYStore._read_pools[self.db_path]
+            for db in pool.connections:
+                await db.close()
+            pool.connections = []
+            raise
+        finally:
+            pool.ready.set()
+        return pool
+
+    async def _release_read_pool(self, pool: _ReadPool) -> None:
+        pool.users -= 1
+        if pool.users:
+            return
+        if SQLiteYStore._read_pools.get(self.db_path) is pool:
+            del SQLiteYStore._read_pools[self.db_path]
+        for db in pool.connections:
+            await db.close()
+        pool.connections = []
+
+    @asynccontextmanager
+    async def _read_connection(self) -> AsyncIterator[Connection]:
+        if self._read_pool is None or not self._read_pool.connections:
+            async with self.lock:
+                yield self._db
+        else:
+            pool = self._read_pool
+            db = await pool.receive_stream.receive()
+            try:
+                yield db
+            finally:
+                pool.send_stream.send_nowait(db)
+
+    async def read(
+        self,
+        since: float | YStoreCursor | None = None,
+        until: float | None = None,
+        limit: int | None = None,
+    ) -> AsyncIterator[tuple[bytes, bytes, float]]:
+        """Async iterator for reading the store content, in the order the updates were written.
 
-    async def read(self) -> AsyncIterator[tuple[bytes, bytes, float]]:
-        """Async iterator for reading the store content.
+        Arguments:
+            since: The time after which the updates were written, or the cursor of the last
+                update already read (see `read_with_cursor()`).
+            until: The time until which the updates were written.
+            limit: The maximum number of updates to read.
 
         Returns:
             A tuple of (update, metadata, timestamp) for each update.
         """
+        async for update, metadata, timestamp, _ in self.read_with_cursor(since, until, limit):
+            yield update, metadata, timestamp
+
+    async def read_with_cursor(
+        self,
+        since: float | YStoreCursor | None = None,
+        until: float | None = None,
+        limit: int | None = None,
+    ) -> AsyncIterator[tuple[bytes, bytes, float, YStoreCursor]]:
+        """Async iterator for reading the store content like `read()`, which also returns
+        a cursor after each update, to pass back as `since` to read the next updates.
+
+        Arguments:
+            since: The time after which the updates were written, or the cursor of the last
+                update already read.
+            until: The time until which the updates were written.
+            limit: The maximum number of updates to read.
+
+        Returns:
+            A tuple of (update, metadata, timestamp, cursor) for each update.
+        """
         if self.db_initialized is None:
             raise RuntimeError("YStore not started")
         await self.db_initialized.wait()
+        if self.flush_delay is not None:
+            await self.flush()
         try:
-            async with self.lock:
-                found = False
-                async with self._db:
-                    cursor = await self._db.cursor()
-                    await cursor.execute(
-                        "SELECT yupdate, metadata, timestamp FROM yupdates WHERE path = ?",
-                        (self.path,),
-                    )
-                    for update, metadata, timestamp in await cursor.fetchall():
-                        found = True
-                        yield update, metadata, timestamp
-                if not found:
-                    raise YDocNotFound
+            found = False
+            async for update, metadata, timestamp, rowid in self._read_rows(since, until, limit):
+                found = True
+                yield update, metadata, timestamp, YStoreCursor(timestamp, rowid)
+            # no update in a time range doesn't mean that the document doesn't exist
+            if not found and since is None and until is None and limit is None:
+                raise YDocNotFound
         except Exception:
             raise YDocNotFound
 
+    async def _read_rows(
+        self,
+        since: float | YStoreCursor | None = None,
+        until: float | None = None,
+        limit: int | None = None,
+    ) -> AsyncIterator[tuple[bytes, bytes, float, int]]:
+        conditions = ["path = ?"]
+        parameters: list = [self.path]
+        if isinstance(since, YStoreCursor):
+            # the position of a cursor is the rowid of its update
+            if since._position is None:
+                conditions.append("timestamp > ?")
+                parameters.append(since.timestamp)
+            else:
+                conditions.append("(timestamp, rowid) > (?, ?)")
+                parameters += [since.timestamp, since._position]
+        elif since is not None:
+            conditions.append("timestamp > ?")
+            parameters.append(since)
+        if until is not None:
+            conditions.append("timestamp <= ?")
+            parameters.append(until)
+        last: tuple[float, int] | None = None
+        while limit is None or limit > 0:
+            chunk_size = (
+                self.read_chunk_size if limit is None else min(limit, self.read_chunk_size)
+            )
+            keyset = [] if last is None else ["(timestamp, rowid) > (?, ?)"]
+            # fetch a chunk of updates at a time, and don't hold the connection
+            # while the updates are consumed
+            rows: list = []
+            async with self._read_connection() as db:
+                async with db:
+                    cursor = await db.cursor()
+                    await cursor.execute(
+                        "SELECT yupdate, metadata, timestamp, rowid FROM yupdates "
+                        f"WHERE {' AND '.join(conditions + keyset)} "
+                        "ORDER BY timestamp, rowid LIMIT ?",
+                        (*parameters, *(last or ()), chunk_size),
+                    )
+                    rows = await cursor.fetchall()
+            for row in rows:
+                yield row
+            if len(rows) < chunk_size:
+                return
+            if limit is not None:
+                limit -= len(rows)
+            last = rows[-1][2], rows[-1][3]
+
+    async def compact(self) -> None:
+        """Squash the history of the document into a single update.
+        Updates written while the history is being squashed are kept after it.
+        """
+        if self.db_initialized is None:
+            raise RuntimeError("YStore not started")
+        await self.db_initialized.wait()
+        # the updates counted so far are squashed, the counts don't include the previous
+        # squashed update and the updates written while the history is read stay counted
+        update_count, byte_count = self._update_count or 0, self._byte_count
+        # the history is squashed without holding the lock, so that writes can go on
+        updates: list[bytes] = []
+        row_count = 0
+        async for update, _, timestamp, rowid in self._read_rows():
+            updates.append(update)
+            row_count += 1
+            if len(updates) >= self.read_chunk_size:
+                updates = [await self._merge_updates(updates)]
+        if row_count < 2:
+            # the history is already squashed
+            if self._update_count is not None:
+                self._update_count -= update_count
+                self._byte_count -= byte_count
+            return
+        squashed_update = await self._merge_updates(updates)
+        metadata = await self.get_metadata()
+        async with self.lock:
+            written = False
+            async with self._db:
+                cursor = await self._db.cursor()
+                await cursor.execute(
+                    "DELETE FROM yupdates WHERE path = ? AND (timestamp, rowid) <= (?, ?)",
+                    (self.path, timestamp, rowid),
+                )
+                # the squashed update takes the place of the squashed history
+                await cursor.execute(
+                    "INSERT INTO yupdates VALUES (?, ?, ?, ?)",
+                    (self.path, squashed_update, metadata, timestamp),
+                )
+                written = True
+            if not written:
+                raise RuntimeError("Error while writing the squashed update to the database")
+            # only the updates written while squashing are left to count
+            if self._update_count is not None:
+                self._update_count -= update_count
+                self._byte_count -= byte_count
+
     async def write(self, data: bytes) -> None:
         """Store an update.
 
@@ -474,40 +1388,106 @@ class SQLiteYStore(BaseYStore):
         if self.db_initialized is None:
             raise RuntimeError("YStore not started")
         await self.db_initialized.wait()
+        metadata = await self.get_metadata()
+        row = (self.path, data, metadata, time.time())
+        if self.flush_delay is None:
+            async with self.lock:
+                await self._write_rows([row])
+            return
+
+        flushed = self._flushed
+        self._pending_updates.append(row)
+        self._flush_needed.set()
+        if len(self._pending_updates) >= self.flush_max_updates:
+            self._flush_now.set()
+        if self.flush_wait:
+            await flushed.done.wait()
+            if flushed.exception is not None:
+                raise RuntimeError("Update not written to the database") from flushed.exception
+
+    async def flush(self) -> None:
+        """Write the pending updates to the database, if any."""
         async with self.lock:
-            async with self._db:
-                # first, determine time elapsed since last update
-                cursor = await self._db.cursor()
+            if not self._pending_updates:
+                return
+            rows, self._pending_updates = self._pending_updates, []
+            flushed = self._flushed
+            self._flushed, self._flush_needed, self._flush_now = _Flush(), Event(), Event()
+            try:
+                await self._write_rows(rows)
+            except BaseException as exception:
+                # the rows are kept to be written by the next flush,
+                # but the writers waiting for this one are told that it failed
+                self._pending_updates[:0] = rows
+                self._flush_needed.set()
+                flushed.exception = exception
+                raise
+            finally:
+                flushed.done.set()
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            await self._flush_needed.wait()
+            with move_on_after(self.flush_delay):
+                await self._flush_now.wait()
+            try:
+                await self.flush()
+            except Exception as exception:
+                self.log.error("Error while flushing updates to the database", exc_info=exception)
+
+    async def _write_rows(self, rows: list[tuple[str, bytes, bytes, float]]) -> None:
+        # must be called with the lock acquired
+        written = False
+        async with self._db:
+            cursor = await self._db.cursor()
+            if self._update_count is None:
                 await cursor.execute(
-                    "SELECT timestamp FROM yupdates WHERE path = ? "
-                    "ORDER BY timestamp DESC LIMIT 1",
+                    "SELECT count(*), max(timestamp), total(length(yupdate)) FROM yupdates "
+                    "WHERE path = ?",
                     (self.path,),
                 )
                 row = await cursor.fetchone()
-                diff = (time.time() - row[0]) if row else 0
-
-                if self.document_ttl is not None and diff > self.document_ttl:
-                    # squash updates
-                    ydoc: Doc = Doc()
-                    await cursor.execute(
-                        "SELECT yupdate FROM yupdates WHERE path = ?",
-                        (self.path,),
-                    )
-                    for (update,) in await cursor.fetchall():
-                        ydoc.apply_update(update)
-                    # delete history
-                    await cursor.execute("DELETE FROM yupdates WHERE path = ?", (self.path,))
-                    # insert squashed updates
-                    squashed_update = ydoc.get_update()
-                    metadata = await self.get_metadata()
-                    await cursor.execute(
-                        "INSERT INTO yupdates VALUES (?, ?, ?, ?)",
-                        (self.path, squashed_update, metadata, time.time()),
-                    )
-
-                # finally, write this update to the DB
+                assert row is not None
+                self._update_count, self._last_timestamp, byte_count = row
+                self._byte_count = int(byte_count)
+            update_count = self._update_count
+            byte_count = self._byte_count
+            # first, determine time elapsed since last update
+            diff = 0 if self._last_timestamp is None else time.time() - self._last_timestamp
+
+            if self.document_ttl is not None and diff > self.document_ttl:
+                # squash updates
+                await cursor.execute(
+                    "SELECT yupdate FROM yupdates WHERE path = ?",
+                    (self.path,),
+                )
+                updates = [update for (update,) in await cursor.fetchall()]
+                squashed_update = await run_sync(
+                    _squash_updates,
+                    updates,
+                    size=sum(len(update) for update in updates),
+                    threshold=self.offload_threshold,
+                    limiter=self.offload_limiter,
+                )
+                # delete history
+                await cursor.execute("DELETE FROM yupdates WHERE path = ?", (self.path,))
+                # insert squashed updates
                 metadata = await self.get_metadata()
                 await cursor.execute(
                     "INSERT INTO yupdates VALUES (?, ?, ?, ?)",
-                    (self.path, data, metadata, time.time()),
+                    (self.path, squashed_update, metadata, time.time()),
                 )
+                update_count = 0
+                byte_count = 0
+
+            # finally, write the updates to the DB
+            await cursor.executemany("INSERT INTO yupdates VALUES (?, ?, ?, ?)", rows)
+            written = True
+        # the transaction is rolled back and the exception only logged if it fails
+        if not written:
+            raise RuntimeError("Error while writing updates to the database")
+        # the cached counts are only updated once the transaction is committed
+        self._update_count = update_count + len(rows)
+        self._byte_count = byte_count + sum(len(row[1]) for row in rows)
+        self._last_timestamp = rows[-1][3]
+        self._maybe_compact(self._update_count, self._byte_count)
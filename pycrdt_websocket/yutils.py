@@ -1,8 +1,14 @@
+from __future__ import annotations
+
 from pathlib import Path
+from typing import Callable, Iterable, TypeVar
 
 import anyio
+from anyio import CapacityLimiter, to_process
 from anyio.streams.memory import MemoryObjectSendStream
-from pycrdt import TransactionEvent
+from pycrdt import Decoder, TransactionEvent, write_var_uint
+
+T = TypeVar("T")
 
 
 def put_updates(update_send_stream: MemoryObjectSendStream, event: TransactionEvent) -> None:
@@ -13,6 +19,105 @@ def put_updates(update_send_stream: MemoryObjectSendStream, event: TransactionEv
         pass
 
 
+def read_awareness_update(update: bytes) -> list[tuple[int, int, bytes]]:
+    """Read the entries of an awareness update, without decoding the JSON states.
+
+    Arguments:
+        update: The awareness update.
+
+    Returns:
+        The (client ID, clock, JSON state) of each client in the update.
+    """
+    decoder = Decoder(update)
+    entries = []
+    for _ in range(decoder.read_var_uint()):
+        client_id = decoder.read_var_uint()
+        clock = decoder.read_var_uint()
+        state = decoder.read_message()
+        entries.append((client_id, clock, b"" if state is None else state))
+    return entries
+
+
+def write_awareness_update(entries: Iterable[tuple[int, int, bytes]]) -> bytes:
+    """Write an awareness update from already encoded JSON states.
+
+    Arguments:
+        entries: The (client ID, clock, JSON state) of each client in the update.
+
+    Returns:
+        The awareness update.
+    """
+    entries = list(entries)
+    stream = [write_var_uint(len(entries))]
+    for client_id, clock, state in entries:
+        stream += [
+            write_var_uint(client_id),
+            write_var_uint(clock),
+            write_var_uint(len(state)),
+            state,
+        ]
+    return b"".join(stream)
+
+
+def read_state_vector(state: bytes) -> dict[int, int]:
+    """Read a state vector.
+
+    Arguments:
+        state: The encoded state vector.
+
+    Returns:
+        The clock of each client in the state vector.
+    """
+    decoder = Decoder(state)
+    return {
+        decoder.read_var_uint(): decoder.read_var_uint() for _ in range(decoder.read_var_uint())
+    }
+
+
+def write_state_vector(state: dict[int, int]) -> bytes:
+    """Write a state vector.
+
+    Arguments:
+        state: The clock of each client.
+
+    Returns:
+        The encoded state vector.
+    """
+    stream = [write_var_uint(len(state))]
+    for client_id, clock in state.items():
+        stream += [write_var_uint(client_id), write_var_uint(clock)]
+    return b"".join(stream)
+
+
+async def run_sync(
+    func: Callable[..., T],
+    *args: object,
+    size: int,
+    threshold: int | None,
+    limiter: CapacityLimiter | None = None,
+) -> T:
+    """Run a CRDT operation, in a worker process if it is large enough to block the event loop.
+    The operation must not use a live YDoc, and its function and arguments must be picklable.
+
+    Worker processes are used instead of worker threads, because pycrdt holds the GIL
+    while it merges or encodes updates.
+
+    Arguments:
+        func: The operation to run.
+        args: The arguments of the operation.
+        size: The size of the operation, e.g. the size (in bytes) of the updates it processes.
+        threshold: The size from which the operation is run in a worker process,
+            or None to always run it in the current thread.
+        limiter: An optional capacity limiter for the worker processes.
+
+    Returns:
+        The result of the operation.
+    """
+    if threshold is None or size < threshold:
+        return func(*args)
+    return await to_process.run_sync(func, *args, limiter=limiter)
+
+
 async def get_new_path(path: str) -> str:
     p = Path(path)
     ext = p.suffix
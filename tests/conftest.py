@@ -47,8 +47,10 @@ async def yws_server(request, unused_tcp_port, websocket_server_api):
                 kwargs = request.param
             except AttributeError:
                 kwargs = {}
+            kwargs = dict(kwargs)
+            asgi_server_kwargs = kwargs.pop("asgi_server", {})
             websocket_server = WebsocketServer(**kwargs)
-            app = ASGIServer(websocket_server)
+            app = ASGIServer(websocket_server, **asgi_server_kwargs)
             config = Config()
             config.bind = [f"localhost:{unused_tcp_port}"]
             shutdown_event = Event()
@@ -1,6 +1,11 @@
 import pytest
 from anyio import sleep
-from pycrdt import Map
+from httpx_ws import aconnect_ws
+from pycrdt import Doc, Map, Text
+from utils import Websocket, connected_websockets
+
+from pycrdt_websocket import WebsocketProvider
+from pycrdt_websocket.compression import COMPRESSION_SUBPROTOCOL, CompressedWebsocket
 
 pytestmark = pytest.mark.anyio
 
@@ -22,3 +27,45 @@ async def test_asgi(yws_server, yws_providers):
         ymap2 = ydoc2.get("map", type=Map)
         await sleep(0.1)
         assert str(ymap2) == '{"key":"value"}'
+
+
+class MyCompressedWebsocket(CompressedWebsocket):
+    threshold = 100
+
+
+@pytest.mark.parametrize(
+    "yws_server", [{"asgi_server": {"compression": MyCompressedWebsocket}}], indirect=True
+)
+async def test_asgi_compression(yws_server):
+    port, _ = yws_server
+    url = f"http://localhost:{port}/room"
+    ydoc1 = Doc()
+    ydoc1["text"] = text1 = Text()
+    text1 += "foo" * 1000
+    async with (
+        aconnect_ws(url, subprotocols=[COMPRESSION_SUBPROTOCOL]) as websocket1,
+        aconnect_ws(url) as websocket2,
+    ):
+        # the compression is only negotiated by the client requesting it
+        assert websocket1.subprotocol == COMPRESSION_SUBPROTOCOL
+        assert websocket2.subprotocol is None
+        ydoc2 = Doc()
+        async with (
+            WebsocketProvider(ydoc1, MyCompressedWebsocket(Websocket(websocket1, "room"))),
+            WebsocketProvider(ydoc2, Websocket(websocket2, "room")),
+        ):
+            await sleep(0.5)
+            assert str(ydoc2.get("text", type=Text)) == "foo" * 1000
+
+
+async def test_compressed_websocket():
+    server_websocket, client_websocket = connected_websockets()
+    websocket = MyCompressedWebsocket(Websocket(server_websocket, "room"))
+    for message in (b"\x00" * 10, b"\x00" * 1000):
+        await websocket.send(message)
+        frame = await client_websocket.receive_bytes()
+        # messages above the threshold are compressed
+        assert frame[0] == (len(message) >= MyCompressedWebsocket.threshold)
+        assert len(frame) < len(message) or len(message) < MyCompressedWebsocket.threshold
+        await client_websocket.send_bytes(frame)
+        assert await websocket.recv() == message
@@ -0,0 +1,88 @@
+import pytest
+from anyio import fail_after, sleep
+from pycrdt import (
+    Array,
+    Doc,
+    YMessageType,
+    YSyncMessageType,
+    create_update_message,
+    handle_sync_message,
+)
+from utils import YDocTest
+
+pytest.importorskip("channels")
+
+from channels.layers import InMemoryChannelLayer  # type: ignore[import-not-found,import-untyped]
+
+from pycrdt_websocket.django_channels_consumer import YjsDocWorker
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def anyio_backend():
+    # the worker runs on the asyncio event loop of Django Channels
+    return "asyncio"
+
+
+async def make_worker():
+    worker = YjsDocWorker()
+    worker.channel_layer = InMemoryChannelLayer()
+    channel = await worker.channel_layer.new_channel()
+    await worker.channel_layer.group_add("room", channel)
+    return worker, channel
+
+
+async def receive(worker, channel):
+    with fail_after(1):
+        return (await worker.channel_layer.receive(channel))["message"]
+
+
+async def test_doc_worker_broadcast():
+    worker, channel = await make_worker()
+    await worker.yjs_connect({"room": "room", "channel": channel})
+    assert (await receive(worker, channel))[:2] == bytes(
+        [YMessageType.SYNC, YSyncMessageType.SYNC_STEP1]
+    )
+
+    # the updates are applied to the worker's YDoc, and broadcast merged into one update
+    test_ydoc = YDocTest()
+    for _ in range(3):
+        message = create_update_message(test_ydoc.update())
+        await worker.yjs_sync({"room": "room", "channel": channel, "message": message})
+    assert worker.ydocs["room"].get("array", type=Array).to_py() == [0, 1, 2]
+    ydoc = Doc()
+    handle_sync_message((await receive(worker, channel))[1:], ydoc)
+    assert ydoc.get("array", type=Array).to_py() == [0, 1, 2]
+
+
+async def test_doc_worker_unknown_client(caplog):
+    worker, channel = await make_worker()
+    # the worker was restarted, so it doesn't know the client
+    test_ydoc = YDocTest()
+    message = create_update_message(test_ydoc.update())
+    await worker.yjs_sync({"room": "room", "channel": channel, "message": message})
+    assert "from a client that is not connected" in caplog.text
+
+    # the YDoc is loaded and the client is asked for the updates the worker doesn't have
+    assert (await receive(worker, channel))[:2] == bytes(
+        [YMessageType.SYNC, YSyncMessageType.SYNC_STEP1]
+    )
+    assert worker.ydocs["room"].get("array", type=Array).to_py() == [0]
+    assert worker._channels["room"] == {channel}
+
+
+async def test_doc_worker_flush_error(caplog):
+    worker, channel = await make_worker()
+    await worker.yjs_connect({"room": "room", "channel": channel})
+
+    async def group_send(group, message):
+        raise RuntimeError("foo")
+
+    worker.channel_layer.group_send = group_send
+    message = create_update_message(YDocTest().update())
+    await worker.yjs_sync({"room": "room", "channel": channel, "message": message})
+    await sleep(worker.flush_delay * 2)
+    # the exception of the background flush is logged
+    assert "Error while broadcasting the updates of room room" in caplog.text
+    assert not worker._flush_tasks
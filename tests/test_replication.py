@@ -0,0 +1,53 @@
+import pytest
+from anyio import create_task_group, sleep
+from pycrdt import Map, YMessageType, YSyncMessageType
+from utils import RecordingWebsocket
+
+from pycrdt_websocket import YRoom
+from pycrdt_websocket.replication import MemoryBus, YRoomReplicator
+
+pytestmark = pytest.mark.anyio
+
+
+class MyMemoryBus(MemoryBus):
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    async def publish(self, channel, message):
+        self.messages.append(message)
+        await super().publish(channel, message)
+
+
+async def test_replication():
+    bus = MyMemoryBus()
+    async with YRoom() as room1, YRoom() as room2:
+        room1.ydoc["map"] = map1 = Map()
+        map1["key1"] = "value1"
+        room2.ydoc["map"] = map2 = Map()
+        map2["key2"] = "value2"
+
+        async with create_task_group() as tg:
+            websocket = RecordingWebsocket("room")
+            tg.start_soon(room2.serve, websocket)
+
+            async with YRoomReplicator(room1, bus, "room", node_id="node1"):
+                async with YRoomReplicator(room2, bus, "room", node_id="node2"):
+                    await sleep(0.1)
+                    # the nodes synced when the second one joined
+                    assert map1.to_py() == map2.to_py() == {"key1": "value1", "key2": "value2"}
+
+                    message_count = len(bus.messages)
+                    map1["key3"] = "value3"
+                    await sleep(0.1)
+                    assert map2.to_py()["key3"] == "value3"
+                    # the update is published once, and not published back
+                    assert len(bus.messages) == message_count + 1
+
+                    # the clients of the room are sent the updates from the other nodes
+                    assert any(
+                        message[:2] == bytes([YMessageType.SYNC, YSyncMessageType.SYNC_UPDATE])
+                        for message in websocket.messages
+                    )
+
+            websocket.close()
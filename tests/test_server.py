@@ -1,11 +1,30 @@
+import sys
+import tempfile
+from pathlib import Path
+
 import pytest
-from anyio import sleep
+from anyio import create_task_group, fail_after, sleep
+from pycrdt import Array
+from utils import RecordingWebsocket, YDocTest
+
+from pycrdt_websocket import WebsocketServer, YRoom, exception_logger
+from pycrdt_websocket.ystore import SQLiteYStore, TempFileYStore
 
-from pycrdt_websocket import exception_logger
+if sys.version_info < (3, 11):
+    from exceptiongroup import BaseExceptionGroup
 
 pytestmark = pytest.mark.anyio
 
 
+class MyTempFileYStore(TempFileYStore):
+    prefix_dir = "test_server_temp_"
+
+
+class MyWriteBehindSQLiteYStore(SQLiteYStore):
+    db_path = str(Path(tempfile.mkdtemp(prefix="test_server_sql_")) / "ystore.db")
+    flush_delay = 10
+
+
 @pytest.mark.parametrize("websocket_server_api", ["websocket_server_start_stop"], indirect=True)
 @pytest.mark.parametrize("yws_server", [{"exception_handler": exception_logger}], indirect=True)
 async def test_server_restart(yws_server):
@@ -16,3 +35,204 @@ async def test_server_restart(yws_server):
 
     server._task_group.start_soon(raise_error)
     await sleep(0.1)
+
+
+async def test_server_idle_room_ttl():
+    async with create_task_group() as tg:
+        async with WebsocketServer(room_ttl=0.2) as server:
+            websocket = RecordingWebsocket("room")
+            tg.start_soon(server.serve, websocket)
+            await sleep(0.05)
+            websocket.close()
+            await sleep(0.05)
+            # the room is kept after its last client left
+            assert "room" in server.rooms
+            assert (server.room_hits, server.room_misses) == (0, 1)
+
+            websocket = RecordingWebsocket("room")
+            tg.start_soon(server.serve, websocket)
+            await sleep(0.25)
+            # the room is not evicted while a client is connected
+            assert "room" in server.rooms
+            assert (server.room_hits, server.room_misses) == (1, 1)
+            websocket.close()
+            await sleep(0.1)
+            assert "room" in server.rooms
+            await sleep(0.2)
+            assert "room" not in server.rooms
+
+
+async def test_server_max_idle_rooms():
+    async with create_task_group() as tg:
+        async with WebsocketServer(max_idle_rooms=1) as server:
+            websockets = [RecordingWebsocket(f"room{i}") for i in range(3)]
+            for websocket in websockets:
+                tg.start_soon(server.serve, websocket)
+            await sleep(0.05)
+            for websocket in websockets:
+                websocket.close()
+                await sleep(0.05)
+            # only the most recently used room is kept
+            assert list(server.rooms) == ["room2"]
+            assert (server.room_hits, server.room_misses) == (0, 3)
+
+
+async def test_server_ystore_factory():
+    test_ydoc = YDocTest()
+    ystore = MyTempFileYStore("room")
+    Path(ystore.path).unlink(missing_ok=True)
+    for _ in range(3):
+        await ystore.write(test_ydoc.update())
+
+    ystores = []
+
+    def ystore_factory(name):
+        ystores.append(MyTempFileYStore(name))
+        return ystores[-1]
+
+    async with create_task_group() as tg:
+        async with WebsocketServer(ystore_factory=ystore_factory) as server:
+            websockets = [RecordingWebsocket("room") for _ in range(10)]
+            for websocket in websockets:
+                tg.start_soon(server.serve, websocket)
+            await sleep(0.1)
+            # the room is created and loaded once
+            assert len(ystores) == 1
+            assert (server.room_hits, server.room_misses) == (0, 1)
+            room = server.rooms["room"]
+            assert len(room.clients) == 10
+            assert room.ydoc.get("array", type=Array).to_py() == [0, 1, 2]
+            # the loaded updates are not written back to the store
+            assert len([update async for update, *rest in ystore.read()]) == 3
+            room.ydoc["array"].append(3)
+            await sleep(0.1)
+            assert len([update async for update, *rest in ystore.read()]) == 4
+            for websocket in websockets:
+                websocket.close()
+            await sleep(0.1)
+            # the store created by the server is stopped with the room
+            assert "room" not in server.rooms
+            assert ystores[0].stopped.is_set()
+            assert ystores[0]._file is None
+
+
+async def test_server_stop_rooms():
+    Path(MyWriteBehindSQLiteYStore.db_path).unlink(missing_ok=True)
+    ystores = []
+
+    def ystore_factory(name):
+        ystores.append(MyWriteBehindSQLiteYStore(name))
+        return ystores[-1]
+
+    async with WebsocketServer(ystore_factory=ystore_factory, room_ttl=10) as server:
+        room = await server.get_room("room")
+        await sleep(0.1)
+        room.ydoc["array"] = Array([0])
+        await sleep(0.1)
+        idle_room = await server.get_room("idle_room")
+        await server._release_room(idle_room)
+
+    # the rooms are stopped, and their stores flushed and stopped
+    assert not server.rooms
+    assert not server._idle_rooms
+    assert all(ystore.stopped.is_set() for ystore in ystores)
+    async with MyWriteBehindSQLiteYStore("room") as ystore:
+        assert len([update async for update, *rest in ystore.read()]) == 1
+
+
+async def test_server_room_factory():
+    names = []
+
+    async def room_factory(name):
+        names.append(name)
+        await sleep(0.05)
+        return YRoom(ready=False)
+
+    async with create_task_group() as tg:
+        async with WebsocketServer(room_factory=room_factory) as server:
+            websockets = [RecordingWebsocket("room") for _ in range(10)]
+            for websocket in websockets:
+                tg.start_soon(server.serve, websocket)
+            await sleep(0.1)
+            assert names == ["room"]
+            room = server.rooms["room"]
+            assert room.started.is_set()
+            assert not room.ready
+            assert len(room.clients) == 10
+            for websocket in websockets:
+                websocket.close()
+
+
+async def test_server_single_flight_room_creation():
+    rooms = []
+
+    async def room_factory(name):
+        await sleep(0.1)
+        rooms.append(YRoom())
+        return rooms[-1]
+
+    async with create_task_group() as tg:
+        async with WebsocketServer(room_factory=room_factory) as server:
+            websockets = [RecordingWebsocket("room") for _ in range(1000)]
+            for websocket in websockets:
+                tg.start_soon(server.serve, websocket)
+            with fail_after(10):
+                for _ in range(100):
+                    await sleep(0.1)
+                    if "room" in server.rooms and len(server.rooms["room"].clients) == 1000:
+                        break
+            # the room is created and started once for all the connections
+            assert len(rooms) == 1
+            assert server.rooms["room"] is rooms[0]
+            assert (server.room_hits, server.room_misses) == (0, 1)
+            for websocket in websockets:
+                websocket.close()
+
+
+async def test_server_room_creation_error():
+    exceptions = []
+
+    def exception_handler(exception, log):
+        while isinstance(exception, BaseExceptionGroup):
+            (exception,) = exception.exceptions
+        exceptions.append(exception)
+        return True
+
+    async def room_factory(name):
+        await sleep(0.1)
+        raise RuntimeError("foo")
+
+    async with create_task_group() as tg:
+        server = WebsocketServer(room_factory=room_factory, exception_handler=exception_handler)
+        async with server:
+            for _ in range(10):
+                tg.start_soon(server.serve, RecordingWebsocket("room"))
+            await sleep(0.2)
+            # the error is raised once, and propagated to all the connections
+            assert len(exceptions) == 10
+            assert str(exceptions[0]) == "foo"
+            assert all(exception.__cause__ is exceptions[0] for exception in exceptions[1:])
+            assert "room" not in server.rooms
+
+
+async def test_server_room_names():
+    async with WebsocketServer() as server:
+        room0 = await server.get_room("room0")
+        room1 = await server.get_room("room1")
+        assert server.get_room_name(room0) == "room0"
+        assert server.get_room_name(room1) == "room1"
+
+        server.rename_room("room2", from_room=room1)
+        assert server.get_room_name(room1) == "room2"
+
+        # rooms can also be added and renamed directly
+        room3 = YRoom()
+        server.rooms["room3"] = room3
+        assert server.get_room_name(room3) == "room3"
+        server.rooms["room4"] = server.rooms.pop("room0")
+        assert server.get_room_name(room0) == "room4"
+
+        await server.delete_room(room=room0)
+        with pytest.raises(ValueError):
+            server.get_room_name(room0)
+        assert list(server.rooms) == ["room2", "room3"]
@@ -0,0 +1,146 @@
+import subprocess
+import sys
+from functools import partial
+from socket import socket
+
+import pytest
+from anyio import Event, create_task_group, fail_after, sleep
+from httpx_ws import WebSocketDisconnect, aconnect_ws
+from hypercorn import Config
+from pycrdt import Doc, Map
+from sniffio import current_async_library
+from utils import Websocket, ensure_server_running
+
+from pycrdt_websocket import WebsocketProvider
+from pycrdt_websocket.sharding import HashRing, ShardRouter
+
+pytestmark = pytest.mark.anyio
+
+WORKER = """
+import asyncio
+import sys
+
+from hypercorn import Config
+from hypercorn.asyncio import serve
+
+from pycrdt_websocket import ASGIServer, WebsocketServer
+
+
+async def main():
+    config = Config()
+    config.bind = [f"localhost:{sys.argv[1]}"]
+    async with WebsocketServer() as websocket_server:
+        await serve(ASGIServer(websocket_server), config, mode="asgi")
+
+
+asyncio.run(main())
+"""
+
+
+def get_unused_tcp_port() -> int:
+    with socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def workers():
+    ports = [get_unused_tcp_port() for _ in range(2)]
+    processes = [subprocess.Popen([sys.executable, "-c", WORKER, str(port)]) for port in ports]
+    yield ports
+    for process in processes:
+        process.kill()
+        process.wait()
+
+
+@pytest.fixture
+async def shard_router(workers):
+    with fail_after(10):
+        for worker_port in workers:
+            await ensure_server_running("localhost", worker_port)
+    port = get_unused_tcp_port()
+    router = ShardRouter([f"http://localhost:{worker_port}" for worker_port in workers])
+    config = Config()
+    config.bind = [f"localhost:{port}"]
+    shutdown_event = Event()
+    if current_async_library() == "trio":
+        from hypercorn.trio import serve
+    else:
+        from hypercorn.asyncio import serve
+    async with create_task_group() as tg:
+        tg.start_soon(
+            partial(serve, router, config, shutdown_trigger=shutdown_event.wait, mode="asgi")
+        )
+        await ensure_server_running("localhost", port)
+        yield f"http://localhost:{port}", router
+        shutdown_event.set()
+
+
+async def connect_provider(url, ydoc, *, task_status):
+    async with aconnect_ws(url) as websocket:
+        async with WebsocketProvider(ydoc, Websocket(websocket, url)):
+            task_status.started()
+            await Event().wait()
+
+
+def test_hash_ring():
+    nodes = [f"node{i}" for i in range(4)]
+    ring = HashRing(nodes)
+    keys = [f"/room{i}" for i in range(1000)]
+    mapping = {key: ring.get_node(key) for key in keys}
+    # the keys are spread across the nodes
+    for node in nodes:
+        assert list(mapping.values()).count(node) > 100
+
+    # removing a node only moves its keys
+    ring.remove_node("node0")
+    for key in keys:
+        if mapping[key] != "node0":
+            assert ring.get_node(key) == mapping[key]
+        else:
+            assert ring.get_node(key) != "node0"
+
+    # adding a node only moves keys to it
+    ring.add_node("node0")
+    ring.add_node("node4")
+    for key in keys:
+        node = ring.get_node(key)
+        assert node in (mapping[key], "node4")
+
+
+async def test_shard_router(shard_router):
+    url, router = shard_router
+    worker = router.get_worker("/room")
+    (other_worker,) = router.workers - {worker}
+    ydocs = [Doc() for _ in range(4)]
+    async with create_task_group() as tg:
+        # clients connected through the router
+        await tg.start(connect_provider, f"{url}/room", ydocs[0])
+        await tg.start(connect_provider, f"{url}/room", ydocs[1])
+        # clients connected directly to the workers
+        await tg.start(connect_provider, f"{worker}/room", ydocs[2])
+        await tg.start(connect_provider, f"{other_worker}/room", ydocs[3])
+        ydocs[0]["map"] = ymap = Map()
+        ymap["key"] = "value"
+        await sleep(0.5)
+        # the room is served by one worker
+        for ydoc in ydocs[1:3]:
+            assert ydoc.get("map", type=Map).to_py() == {"key": "value"}
+        assert ydocs[3].get("map", type=Map).to_py() == {}
+        tg.cancel_scope.cancel()
+
+
+async def test_shard_router_rebalance(shard_router):
+    url, router = shard_router
+    worker = router.get_worker("/room")
+    (other_worker,) = router.workers - {worker}
+    async with aconnect_ws(f"{url}/room") as websocket:
+        # the worker sends a SYNC_STEP1 message when the client connects
+        await websocket.receive_bytes()
+        router.set_workers([other_worker])
+        with fail_after(5), pytest.raises(WebSocketDisconnect) as exc_info:
+            while True:
+                await websocket.receive_bytes()
+        # the client is told to reconnect
+        assert exc_info.value.code == 1012
+    assert router.get_worker("/room") == other_worker
@@ -1,10 +1,24 @@
+from functools import partial
+
 import pytest
-from anyio import TASK_STATUS_IGNORED, create_task_group, sleep
+from anyio import TASK_STATUS_IGNORED, Event, create_task_group, fail_after, sleep, sleep_forever
 from anyio.abc import TaskStatus
-from pycrdt import Map
-from utils import Websocket
+from pycrdt import (
+    Array,
+    Awareness,
+    Doc,
+    Map,
+    Text,
+    YMessageType,
+    YSyncMessageType,
+    create_awareness_message,
+    create_sync_message,
+    read_message,
+)
+from utils import RecordingWebsocket, Websocket, connected_websockets
 
 from pycrdt_websocket import exception_logger
+from pycrdt_websocket.asgi_server import ASGIWebsocket
 from pycrdt_websocket.yroom import YRoom
 
 pytestmark = pytest.mark.anyio
@@ -56,3 +70,291 @@ async def test_yroom_restart(yws_server, yws_provider):
     assert yroom._task_group is not None
     assert not yroom._task_group.cancel_scope.cancel_called
     await yroom.stop()
+
+
+@pytest.mark.parametrize("yroom", [{"batch_max_delay": 0.1}], indirect=True)
+async def test_yroom_batch_updates(yroom, room_name):
+    websocket = RecordingWebsocket(room_name)
+    async with create_task_group() as tg:
+        tg.start_soon(yroom.serve, websocket)
+        await sleep(0.01)
+        yroom.ydoc["array"] = array = Array()
+        for i in range(10):
+            array.append(i)
+        await sleep(0.2)
+        tg.cancel_scope.cancel()
+
+    sync_update = bytes([YMessageType.SYNC, YSyncMessageType.SYNC_UPDATE])
+    updates = [message for message in websocket.messages if message[:2] == sync_update]
+    assert len(updates) == 1
+    assert yroom.updates_received == 10
+    assert yroom.update_messages_sent == 1
+    ydoc = Doc()
+    ydoc.apply_update(read_message(updates[0][2:]))
+    assert ydoc.get("array", type=Array).to_py() == list(range(10))
+
+
+def get_update_messages(messages: list[bytes]) -> list[bytes]:
+    sync_types = (YSyncMessageType.SYNC_STEP2, YSyncMessageType.SYNC_UPDATE)
+    return [
+        read_message(message[2:])
+        for message in messages
+        if message[0] == YMessageType.SYNC and message[1] in sync_types
+    ]
+
+
+@pytest.mark.parametrize(
+    "yroom", [{"send_queue_size": 2, "slow_client_policy": "resync"}], indirect=True
+)
+async def test_yroom_slow_client_resync(yroom, room_name):
+    send_event = Event()
+    websocket = RecordingWebsocket(room_name, send_event)
+    async with create_task_group() as tg:
+        tg.start_soon(yroom.serve, websocket)
+        await sleep(0.01)
+        yroom.ydoc["array"] = array = Array()
+        for i in range(10):
+            array.append(i)
+        await sleep(0.1)
+        send_event.set()
+        await sleep(0.1)
+        tg.cancel_scope.cancel()
+
+    # the dropped updates were replaced with the document state
+    assert len(websocket.messages) < 10
+    ydoc = Doc()
+    for update in get_update_messages(websocket.messages):
+        ydoc.apply_update(update)
+    assert ydoc.get("array", type=Array).to_py() == list(range(10))
+
+
+@pytest.mark.parametrize(
+    "yroom", [{"send_queue_size": 2, "slow_client_policy": "disconnect"}], indirect=True
+)
+async def test_yroom_slow_client_disconnect(yroom, room_name):
+    websocket = RecordingWebsocket(room_name, Event())
+    disconnected = Event()
+
+    async def serve():
+        await yroom.serve(websocket)
+        disconnected.set()
+
+    async with create_task_group() as tg:
+        tg.start_soon(serve)
+        await sleep(0.01)
+        assert websocket in yroom.clients
+        yroom.ydoc["array"] = array = Array()
+        for i in range(10):
+            array.append(i)
+        with fail_after(1):
+            await disconnected.wait()
+
+    assert websocket not in yroom.clients
+
+
+async def test_yroom_prepared_frames(yroom, room_name):
+    frames: list[tuple[int, dict]] = []
+
+    async def receive():
+        await sleep_forever()
+
+    async def send(idx, frame):
+        frames.append((idx, frame))
+
+    client_nb = 10
+    websockets = [
+        ASGIWebsocket(receive, partial(send, idx), room_name) for idx in range(client_nb)
+    ]
+    async with create_task_group() as tg:
+        for websocket in websockets:
+            tg.start_soon(yroom.serve, websocket)
+        await sleep(0.01)
+        yroom.ydoc["array"] = array = Array()
+        array.append(0)
+        await sleep(0.1)
+        tg.cancel_scope.cancel()
+
+    sync_update = bytes([YMessageType.SYNC, YSyncMessageType.SYNC_UPDATE])
+    update_frames = [(idx, frame) for idx, frame in frames if frame["bytes"][:2] == sync_update]
+    # every client got the update, framed only once
+    assert sorted(idx for idx, _ in update_frames) == list(range(client_nb))
+    assert len({id(frame) for _, frame in update_frames}) == 1
+
+
+@pytest.mark.parametrize("yroom", [{"awareness_flush_interval": 0.1}], indirect=True)
+async def test_yroom_awareness_coalescing(yroom, room_name):
+    websockets = [connected_websockets() for _ in range(2)]
+    awarenesses = [Awareness(Doc()) for _ in range(3)]
+
+    async def send_awareness(awareness, client_websocket):
+        update = awareness.encode_awareness_update([awareness.client_id])
+        await client_websocket.send_bytes(create_awareness_message(update))
+
+    def received_messages(client_websocket):
+        messages = []
+        while client_websocket.receive_stream.statistics().current_buffer_used:
+            messages.append(client_websocket.receive_stream.receive_nowait())
+        return messages
+
+    async with create_task_group() as tg:
+        for server_websocket, _ in websockets:
+            tg.start_soon(yroom.serve, Websocket(server_websocket, room_name))
+        await sleep(0.01)
+        for _, client_websocket in websockets:
+            received_messages(client_websocket)
+        for i in range(10):
+            for awareness in awarenesses:
+                awareness.set_local_state({"cursor": i})
+                await send_awareness(awareness, websockets[0][1])
+        await sleep(0.2)
+        # the latest states of all the clients were sent to each client in a single message,
+        # or two if a flush happened while the messages were being received
+        for _, client_websocket in websockets:
+            messages = received_messages(client_websocket)
+            assert len(messages) <= 2
+            awareness = Awareness(Doc())
+            for message in messages:
+                assert message[0] == YMessageType.AWARENESS
+                awareness.apply_awareness_update(read_message(message[1:]), None)
+            for client_awareness in awarenesses:
+                assert awareness.states[client_awareness.client_id] == {"cursor": 9}
+
+        # disconnections are sent right away
+        awarenesses[0].set_local_state(None)
+        await send_awareness(awarenesses[0], websockets[0][1])
+        with fail_after(0.05):
+            message = await websockets[1][1].receive_bytes()
+        assert message[0] == YMessageType.AWARENESS
+        tg.cancel_scope.cancel()
+
+
+@pytest.mark.parametrize(
+    "yroom",
+    [
+        {"lightweight_awareness": True},
+        {"lightweight_awareness": True, "awareness_flush_interval": 0.05},
+    ],
+    indirect=True,
+)
+async def test_yroom_lightweight_awareness(yroom, room_name):
+    websockets = [connected_websockets() for _ in range(2)]
+    awareness = Awareness(Doc())
+    awareness.set_local_state({"cursor": 0})
+    update = awareness.encode_awareness_update([awareness.client_id])
+    async with create_task_group() as tg:
+        async with create_task_group() as tg0:
+            tg0.start_soon(yroom.serve, Websocket(websockets[0][0], room_name))
+            tg.start_soon(yroom.serve, Websocket(websockets[1][0], room_name))
+            await sleep(0.01)
+            await websockets[0][1].send_bytes(create_awareness_message(update))
+            await sleep(0.1)
+            # the server doesn't keep the client's state
+            assert awareness.client_id not in yroom.awareness.states
+            # the first WebSocket closes without sending a disconnection message
+            tg0.cancel_scope.cancel()
+
+        client_awareness = Awareness(Doc())
+        with fail_after(1):
+            while True:
+                message = await websockets[1][1].receive_bytes()
+                if message[0] == YMessageType.AWARENESS:
+                    client_awareness.apply_awareness_update(read_message(message[1:]), None)
+                    if awareness.client_id in client_awareness.states:
+                        break
+        assert client_awareness.states[awareness.client_id] == {"cursor": 0}
+        with fail_after(1):
+            message = await websockets[1][1].receive_bytes()
+        client_awareness.apply_awareness_update(read_message(message[1:]), None)
+        # the other client was told that the client is gone
+        assert awareness.client_id not in client_awareness.states
+        tg.cancel_scope.cancel()
+
+
+@pytest.mark.parametrize(
+    "yroom",
+    [{"sync_step2_chunk_size": 1000}, {"sync_step2_chunk_size": 1000, "offload_threshold": 0}],
+    indirect=True,
+)
+async def test_yroom_sync_step2_chunks(yroom, room_name):
+    # a document edited by many clients
+    for i in range(20):
+        ydoc = Doc()
+        ydoc.apply_update(yroom.ydoc.get_update())
+        ydoc.get("text", type=Text).insert(0, str(i) * 500)
+        yroom.ydoc.apply_update(ydoc.get_update(yroom.ydoc.get_state()))
+    update = yroom.ydoc.get_update()
+    # let the room broadcast these updates before the client joins
+    await sleep(0.1)
+
+    server_websocket, client_websocket = connected_websockets()
+    ydoc = Doc()
+    async with create_task_group() as tg:
+        tg.start_soon(yroom.serve, Websocket(server_websocket, room_name))
+        # the SYNC_STEP1 message sent when the client connects
+        await client_websocket.receive_bytes()
+        await client_websocket.send_bytes(create_sync_message(ydoc))
+        messages = []
+        with fail_after(1):
+            while True:
+                message = await client_websocket.receive_bytes()
+                messages.append(message)
+                if message[1] == YSyncMessageType.SYNC_STEP2:
+                    break
+        tg.cancel_scope.cancel()
+
+    # the document state was sent in chunks, ending with a SYNC_STEP2 message
+    assert len(messages) > 5
+    assert all(message[1] == YSyncMessageType.SYNC_UPDATE for message in messages[:-1])
+    assert all(len(message) < len(update) / 5 for message in messages)
+    for message in messages:
+        ydoc.apply_update(read_message(message[2:]))
+    assert str(ydoc.get("text", type=Text)) == str(yroom.ydoc.get("text", type=Text))
+
+
+class SlowJoiningWebsocket(RecordingWebsocket):
+    def __init__(self, path: str):
+        super().__init__(path)
+        self._sync_message: bytes | None = create_sync_message(Doc())
+        self.synced = Event()
+
+    async def send(self, message: bytes):
+        await sleep(0.01)
+        await super().send(message)
+        if message[1] == YSyncMessageType.SYNC_STEP2:
+            self.synced.set()
+
+    async def recv(self) -> bytes:
+        if self._sync_message is not None:
+            message, self._sync_message = self._sync_message, None
+            return message
+        return await super().recv()
+
+
+@pytest.mark.parametrize(
+    "yroom",
+    [{"sync_step2_chunk_size": 1000, "send_queue_size": 2, "slow_client_policy": "resync"}],
+    indirect=True,
+)
+async def test_yroom_sync_step2_chunks_slow_client(yroom, room_name):
+    for i in range(20):
+        ydoc = Doc()
+        ydoc.apply_update(yroom.ydoc.get_update())
+        ydoc.get("text", type=Text).insert(0, str(i) * 500)
+        yroom.ydoc.apply_update(ydoc.get_update(yroom.ydoc.get_state()))
+    await sleep(0.1)
+
+    websocket = SlowJoiningWebsocket(room_name)
+    async with create_task_group() as tg:
+        tg.start_soon(yroom.serve, websocket)
+        with fail_after(2):
+            await websocket.synced.wait()
+        tg.cancel_scope.cancel()
+
+    # the chunks waited for the slow client, which was not resynchronized with the
+    # whole document state: no message is larger than about a chunk
+    assert len(websocket.messages) > 5
+    assert all(len(message) < 2500 for message in websocket.messages)
+    ydoc = Doc()
+    for update in get_update_messages(websocket.messages):
+        ydoc.apply_update(update)
+    assert str(ydoc.get("text", type=Text)) == str(yroom.ydoc.get("text", type=Text))
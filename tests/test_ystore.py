@@ -1,10 +1,12 @@
+import struct
 import tempfile
 import time
 from pathlib import Path
 from unittest.mock import patch
 
 import pytest
-from anyio import create_task_group
+from anyio import create_task_group, fail_after, sleep, to_process
+from pycrdt import Array, Doc, write_var_uint
 from sqlite_anyio import connect
 from utils import StartStopContextManager, YDocTest
 
@@ -106,6 +108,519 @@ async def test_document_ttl_sqlite_ystore(ystore_api):
             await db.close()
 
 
+async def test_sqlite_ystore_cached_document_state():
+    test_ydoc = YDocTest()
+    ystore = MySQLiteYStore("my_cached_store", delete=True)
+    async with ystore:
+        now = time.time()
+        with patch("time.time") as mock_time:
+            mock_time.return_value = now
+            # the state of the document is loaded on the first write
+            await ystore.write(test_ydoc.update())
+            statements = []
+            ystore._db._real_connection.set_trace_callback(statements.append)
+            for _ in range(3):
+                await ystore.write(test_ydoc.update())
+            # and then kept up-to-date without querying the database
+            assert statements
+            assert not [s for s in statements if s.lstrip().upper().startswith("SELECT")]
+
+            # the document history is still squashed after the document TTL,
+            # based on the cached timestamp of the latest update
+            statements.clear()
+            mock_time.return_value = now + ystore.document_ttl + 1
+            await ystore.write(test_ydoc.update())
+            assert not [s for s in statements if "max(timestamp)" in s]
+            ystore._db._real_connection.set_trace_callback(None)
+        assert len([d async for d, m, t in ystore.read()]) == 2
+
+
+class MyWriteBehindSQLiteYStore(MySQLiteYStore):
+    flush_delay = 0.1
+    flush_max_updates = 5
+
+
+@pytest.mark.parametrize("ystore_api", ("ystore_context_manager", "ystore_start_stop"))
+async def test_write_behind_sqlite_ystore(ystore_api):
+    async with create_task_group() as tg:
+        test_ydoc = YDocTest()
+        store_name = f"my_store_with_api_{ystore_api}"
+        ystore = MyWriteBehindSQLiteYStore(store_name, delete=True)
+        if ystore_api == "ystore_start_stop":
+            ystore = StartStopContextManager(ystore, tg)
+
+        async def count():
+            return (await (await cursor.execute("SELECT count(*) FROM yupdates")).fetchone())[0]
+
+        async with ystore as ystore:
+            db = await connect(ystore.db_path)
+            cursor = await db.cursor()
+
+            # updates are written after the flush delay
+            for _ in range(3):
+                await ystore.write(test_ydoc.update())
+            assert await count() == 0
+            await sleep(0.2)
+            assert await count() == 3
+
+            # or as soon as there are enough of them
+            for _ in range(5):
+                await ystore.write(test_ydoc.update())
+            await sleep(0.05)
+            assert await count() == 8
+
+            # pending updates are read
+            await ystore.write(test_ydoc.update())
+            assert len([update async for update in ystore.read()]) == 9
+
+            # and written when the store stops
+            await ystore.write(test_ydoc.update())
+
+        assert await count() == 10
+        await db.close()
+
+
+class MyWaitingWriteBehindSQLiteYStore(MyWriteBehindSQLiteYStore):
+    flush_wait = True
+
+
+async def test_write_behind_sqlite_ystore_failure():
+    test_ydoc = YDocTest()
+    ystore = MyWaitingWriteBehindSQLiteYStore("my_failing_store", delete=True)
+    async with ystore:
+        await ystore.db_initialized.wait()
+        db = await connect(ystore.db_path)
+        cursor = await db.cursor()
+        await cursor.execute(
+            "CREATE TRIGGER fail BEFORE INSERT ON yupdates BEGIN SELECT RAISE(ABORT, 'foo'); END"
+        )
+        await db.commit()
+        update = test_ydoc.update()
+        # the writer waiting for the flush is told that it failed
+        with pytest.raises(RuntimeError):
+            await ystore.write(update)
+        # but the update is not lost, it is written by the next flush
+        await cursor.execute("DROP TRIGGER fail")
+        await db.commit()
+        await ystore.flush()
+        assert [d async for d, m, t in ystore.read()] == [update]
+        await db.close()
+
+
+class MyPooledSQLiteYStore(MySQLiteYStore):
+    pragmas = {"journal_mode": "wal", "synchronous": "normal"}
+    read_pool_size = 2
+
+
+@pytest.mark.parametrize("ystore_api", ("ystore_context_manager", "ystore_start_stop"))
+async def test_pooled_sqlite_ystore(ystore_api):
+    async with create_task_group() as tg:
+        store_name = f"my_store_with_api_{ystore_api}"
+        ystore = MyPooledSQLiteYStore(store_name, delete=True)
+        if ystore_api == "ystore_start_stop":
+            ystore = StartStopContextManager(ystore, tg)
+
+        async with ystore as ystore:
+            await ystore.write(b"foo")
+            db = await connect(ystore.db_path)
+            cursor = await db.cursor()
+            await cursor.execute("PRAGMA journal_mode")
+            assert (await cursor.fetchone())[0] == "wal"
+            await db.close()
+
+            # reading doesn't wait for writes
+            async with ystore.lock:
+                with fail_after(1):
+                    assert [d async for d, m, t in ystore.read()] == [b"foo"]
+
+            # the stores of the documents in the same database share the read pool
+            async with MyPooledSQLiteYStore("my_other_store") as other_ystore:
+                await other_ystore.write(b"bar")
+                assert other_ystore._read_pool is ystore._read_pool
+                assert len(ystore._read_pool.connections) == MyPooledSQLiteYStore.read_pool_size
+                assert [d async for d, m, t in other_ystore.read()] == [b"bar"]
+            pool = ystore._read_pool
+            assert pool.connections
+
+        # the connections are closed when the last store using them stops
+        assert not pool.connections
+        assert MyPooledSQLiteYStore.db_path not in MyPooledSQLiteYStore._read_pools
+
+
+class MyChunkedSQLiteYStore(MySQLiteYStore):
+    read_chunk_size = 2
+
+
+@pytest.mark.parametrize("ystore_api", ("ystore_context_manager", "ystore_start_stop"))
+async def test_chunked_read_sqlite_ystore(ystore_api):
+    async with create_task_group() as tg:
+        store_name = f"my_store_with_api_{ystore_api}"
+        ystore = MyChunkedSQLiteYStore(store_name, delete=True)
+        if ystore_api == "ystore_start_stop":
+            ystore = StartStopContextManager(ystore, tg)
+
+        async with ystore as ystore:
+            data = [str(i).encode() for i in range(5)]
+            now = time.time()
+            with patch("time.time") as mock_time:
+                # updates with the same timestamp are read in insertion order
+                mock_time.return_value = now
+                for d in data:
+                    await ystore.write(d)
+            read_data = []
+            async for d, m, t in ystore.read():
+                read_data.append(d)
+                # the store can be written to while it is being read
+                with fail_after(1):
+                    async with ystore.lock:
+                        pass
+            assert read_data == data
+
+
+class MyCompactedTempFileYStore(MyTempFileYStore):
+    compaction_max_updates = 5
+    compaction_interval = 0
+
+
+class MyCompactedSQLiteYStore(MySQLiteYStore):
+    compaction_max_updates = 5
+    compaction_interval = 0
+
+
+@pytest.mark.parametrize("YStore", (MyCompactedTempFileYStore, MyCompactedSQLiteYStore))
+@pytest.mark.parametrize("ystore_api", ("ystore_context_manager", "ystore_start_stop"))
+async def test_compaction(YStore, ystore_api):
+    async with create_task_group() as tg:
+        test_ydoc = YDocTest()
+        store_name = f"my_store_with_api_{ystore_api}"
+        ystore = YStore(store_name, delete=True)
+        if ystore_api == "ystore_start_stop":
+            ystore = StartStopContextManager(ystore, tg)
+
+        async with ystore as ystore:
+            for _ in range(20):
+                await ystore.write(test_ydoc.update())
+                await sleep(0.01)
+            await sleep(0.1)
+
+            updates = [update async for update, *rest in ystore.read()]
+            assert len(updates) <= 6
+            ydoc = Doc()
+            for update in updates:
+                ydoc.apply_update(update)
+            assert ydoc.get("array", type=Array).to_py() == list(range(20))
+
+
+class MySizeCompactedTempFileYStore(MyTempFileYStore):
+    compaction_max_bytes = 1000
+    compaction_interval = 0
+
+
+class MySizeCompactedSQLiteYStore(MySQLiteYStore):
+    compaction_max_bytes = 1000
+    compaction_interval = 0
+
+
+@pytest.mark.parametrize("YStore", (MySizeCompactedTempFileYStore, MySizeCompactedSQLiteYStore))
+async def test_compaction_of_large_document(YStore):
+    ydoc = Doc()
+    ydoc["array"] = array = Array()
+    ystore = YStore("my_large_store", delete=True)
+    async with ystore:
+        compactions = []
+        compact = ystore.compact
+
+        async def count_compactions():
+            compactions.append(None)
+            await compact()
+
+        ystore.compact = count_compactions
+        state = ydoc.get_state()
+        array.append("x" * 2000)
+        await ystore.write(ydoc.get_update(state))
+        await sleep(0.1)
+        assert len(compactions) == 1
+
+        # the document is larger than the threshold, but only the updates written
+        # since it was squashed count
+        for i in range(5):
+            state = ydoc.get_state()
+            array.append(i)
+            await ystore.write(ydoc.get_update(state))
+            await sleep(0.01)
+        await sleep(0.1)
+        assert len(compactions) == 1
+
+        # each compaction starts counting again from zero
+        for i in range(2, 5):
+            state = ydoc.get_state()
+            array.append("x" * 1200)
+            await ystore.write(ydoc.get_update(state))
+            await sleep(0.1)
+            assert len(compactions) == i
+            assert (ystore._update_count, ystore._byte_count) == (0, 0)
+        assert len([d async for d, m, t in ystore.read()]) == 1
+
+
+async def test_file_ystore_snapshot():
+    test_ydoc = YDocTest()
+    ystore = MyTempFileYStore("my_snapshot_store", delete=True)
+    for _ in range(3):
+        await ystore.write(test_ydoc.update())
+    # the store is not running, so the file is not kept open
+    assert ystore._file is None
+    await ystore.compact()
+    await ystore.write(test_ydoc.update())
+
+    updates = [update async for update, *rest in ystore.read()]
+    # the snapshot, followed by the update written after it
+    assert len(updates) == 2
+    ydoc = Doc()
+    for update in updates:
+        ydoc.apply_update(update)
+    assert ydoc.get("array", type=Array).to_py() == list(range(4))
+
+    # the file is rewritten with the new snapshot only, and its index is reset
+    assert len([update async for update, *rest in ystore.read_last(1)]) == 1
+    size = Path(ystore.path).stat().st_size
+    await ystore.compact()
+    assert Path(ystore.path).stat().st_size < size
+    assert not Path(f"{ystore.path}.idx").exists()
+    updates = [update async for update, *rest in ystore.read()]
+    assert len(updates) == 1
+    ydoc = Doc()
+    ydoc.apply_update(updates[0])
+    assert ydoc.get("array", type=Array).to_py() == list(range(4))
+
+
+async def test_file_ystore_migration():
+    test_ydoc = YDocTest()
+    ystore = MyTempFileYStore("my_migrated_store", delete=True)
+    # write a store in version 2 format
+    data = [b"VERSION:2\n"]
+    for _ in range(3):
+        for message in (test_ydoc.update(), b"", struct.pack("<d", time.time())):
+            data.append(write_var_uint(len(message)) + message)
+    Path(ystore.path).write_bytes(b"".join(data))
+
+    await ystore.write(test_ydoc.update())
+    assert Path(ystore.path).read_bytes().startswith(b"VERSION:3\n")
+    updates = [update async for update, *rest in ystore.read()]
+    assert len(updates) == 4
+    ydoc = Doc()
+    for update in updates:
+        ydoc.apply_update(update)
+    assert ydoc.get("array", type=Array).to_py() == list(range(4))
+
+
+class MySmallMergeTempFileYStore(MyTempFileYStore):
+    merge_chunk_size = 3
+
+
+class MySmallMergeSQLiteYStore(MySQLiteYStore):
+    merge_chunk_size = 3
+
+
+class MyOffloadedMergeTempFileYStore(MySmallMergeTempFileYStore):
+    offload_threshold = 0
+
+
+class MyOffloadedMergeSQLiteYStore(MySmallMergeSQLiteYStore):
+    offload_threshold = 0
+
+
+@pytest.mark.parametrize(
+    "YStore",
+    (
+        MySmallMergeTempFileYStore,
+        MySmallMergeSQLiteYStore,
+        MyOffloadedMergeTempFileYStore,
+        MyOffloadedMergeSQLiteYStore,
+    ),
+)
+@pytest.mark.parametrize("ystore_api", ("ystore_context_manager", "ystore_start_stop"))
+async def test_apply_updates(YStore, ystore_api):
+    async with create_task_group() as tg:
+        test_ydoc = YDocTest()
+        store_name = f"my_merged_store_with_api_{ystore_api}"
+        ystore = YStore(store_name, delete=True)
+        if ystore_api == "ystore_start_stop":
+            ystore = StartStopContextManager(ystore, tg)
+
+        async with ystore as ystore:
+            for _ in range(10):
+                await ystore.write(test_ydoc.update())
+
+            ydoc = Doc()
+            with (
+                patch.object(ydoc, "apply_update", wraps=ydoc.apply_update) as apply_update,
+                patch.object(to_process, "run_sync", wraps=to_process.run_sync) as run_sync,
+            ):
+                await ystore.apply_updates(ydoc)
+            # the stored updates are applied at once
+            assert apply_update.call_count == 1
+            # the updates are merged in worker processes above the threshold
+            assert run_sync.called == (YStore.offload_threshold is not None)
+            assert ydoc.get("array", type=Array).to_py() == list(range(10))
+
+
+@pytest.mark.parametrize("YStore", (MyTempFileYStore, MySQLiteYStore))
+@pytest.mark.parametrize("ystore_api", ("ystore_context_manager", "ystore_start_stop"))
+async def test_read_range(YStore, ystore_api):
+    async with create_task_group() as tg:
+        test_ydoc = YDocTest()
+        store_name = f"my_range_store_with_api_{ystore_api}"
+        ystore = YStore(store_name, delete=True)
+        if ystore_api == "ystore_start_stop":
+            ystore = StartStopContextManager(ystore, tg)
+
+        async with ystore as ystore:
+            updates = []
+            timestamps = []
+            for _ in range(10):
+                updates.append(test_ydoc.update())
+                await ystore.write(updates[-1])
+                timestamps.append(time.time())
+                await sleep(0.001)
+
+            async def read(**kwargs):
+                return [update async for update, *rest in ystore.read(**kwargs)]
+
+            assert await read(since=timestamps[2]) == updates[3:]
+            assert await read(until=timestamps[2]) == updates[:3]
+            assert await read(since=timestamps[2], until=timestamps[5]) == updates[3:6]
+            assert await read(since=timestamps[2], limit=2) == updates[3:5]
+            assert await read(limit=0) == []
+            assert await read(since=timestamps[9]) == []
+
+            # the timestamp of the last update read is a cursor for the next ones
+            cursor = None
+            read_updates = []
+            while True:
+                chunk = [record async for record in ystore.read(since=cursor, limit=3)]
+                if not chunk:
+                    break
+                read_updates += [update for update, *rest in chunk]
+                cursor = chunk[-1][2]
+            assert read_updates == updates
+
+            # updates written with the same timestamp are told apart by the cursor
+            now = time.time()
+            with patch("time.time") as mock_time:
+                mock_time.return_value = now
+                for _ in range(5):
+                    updates.append(test_ydoc.update())
+                    await ystore.write(updates[-1])
+            cursor = timestamps[-1]
+            read_updates = []
+            while True:
+                chunk = [record async for record in ystore.read_with_cursor(cursor, limit=2)]
+                if not chunk:
+                    break
+                read_updates += [update for update, *rest in chunk]
+                cursor = chunk[-1][3]
+            assert read_updates == updates[10:]
+            assert await read(since=cursor) == []
+
+
+@pytest.mark.parametrize("YStore", (MyTempFileYStore, MySQLiteYStore))
+async def test_read_range_after_compaction(YStore):
+    test_ydoc = YDocTest()
+    ystore = YStore("my_compacted_range_store", delete=True)
+    async with ystore:
+        updates = []
+        timestamps = []
+        for _ in range(6):
+            updates.append(test_ydoc.update())
+            await ystore.write(updates[-1])
+            timestamps.append(time.time())
+            await sleep(0.001)
+        cursors = [cursor async for *_, cursor in ystore.read_with_cursor()]
+        await ystore.compact()
+        updates.append(test_ydoc.update())
+        await ystore.write(updates[-1])
+
+        # a client which has the first updates gets the squashed history back
+        for since in (timestamps[1], cursors[1]):
+            ydoc = Doc()
+            for update in updates[:2]:
+                ydoc.apply_update(update)
+            read_updates = []
+            while True:
+                chunk = [record async for record in ystore.read_with_cursor(since, limit=1)]
+                if not chunk:
+                    break
+                read_updates += [update for update, *rest in chunk]
+                since = chunk[-1][3]
+            assert len(read_updates) == 2
+            for update in read_updates:
+                ydoc.apply_update(update)
+            assert ydoc.get("array", type=Array).to_py() == list(range(7))
+            assert [update async for update, *rest in ystore.read(since=since)] == []
+
+        # a client which has the squashed history only gets the next update
+        assert [update async for update, *rest in ystore.read(since=timestamps[5])] == [
+            updates[-1]
+        ]
+
+
+async def test_file_ystore_indexed_read(caplog):
+    test_ydoc = YDocTest()
+    ystore = MyTempFileYStore("my_indexed_store", delete=True)
+    updates = []
+    timestamps = []
+    for i in range(10):
+        updates.append(test_ydoc.update())
+        await ystore.write(updates[-1])
+        timestamps.append(time.time())
+        if i == 1:
+            # the index is built on first use
+            assert [update async for update, *rest in ystore.read_last(2)] == updates[-2:]
+        if i == 4:
+            await ystore.compact()
+            # the history squashed in the snapshot is not kept
+            assert [update async for update, *rest in ystore.read_last(2)] == []
+
+    assert [update async for update, *rest in ystore.read(since=timestamps[6])] == updates[7:]
+    assert [update async for update, *rest in ystore.read(since=timestamps[9])] == []
+    assert [update async for update, *rest in ystore.read_last(3)] == updates[-3:]
+    assert [update async for update, *rest in ystore.read_last(20)] == updates[5:]
+
+    # an index that doesn't match the file is rebuilt
+    Path(f"{ystore.path}.idx").write_bytes(b"foo")
+    assert [update async for update, *rest in ystore.read_last(3)] == updates[-3:]
+    assert "YStore index mismatch" in caplog.text
+
+
+class MyGroupCommitTempFileYStore(MyTempFileYStore):
+    fsync_interval = 0.1
+
+
+@pytest.mark.parametrize("ystore_api", ("ystore_context_manager", "ystore_start_stop"))
+async def test_file_ystore_group_commit(ystore_api):
+    async with create_task_group() as tg:
+        test_ydoc = YDocTest()
+        store_name = f"my_group_commit_store_with_api_{ystore_api}"
+        ystore = MyGroupCommitTempFileYStore(store_name, delete=True)
+        if ystore_api == "ystore_start_stop":
+            ystore = StartStopContextManager(ystore, tg)
+
+        with patch("os.fsync") as mock_fsync:
+            async with ystore as ystore:
+                for _ in range(10):
+                    await ystore.write(test_ydoc.update())
+                assert mock_fsync.call_count == 0
+                await sleep(0.2)
+                # all the updates are synced at once
+                assert mock_fsync.call_count == 1
+                await ystore.write(test_ydoc.update())
+            # pending updates are synced when the store stops
+            assert mock_fsync.call_count == 2
+
+        updates = [update async for update, *rest in ystore.read()]
+        assert len(updates) == 11
+
+
 @pytest.mark.parametrize("YStore", (MyTempFileYStore, MySQLiteYStore))
 @pytest.mark.parametrize("ystore_api", ("ystore_context_manager", "ystore_start_stop"))
 async def test_version(YStore, ystore_api, caplog):
@@ -1,4 +1,4 @@
-from anyio import Lock, connect_tcp, create_memory_object_stream
+from anyio import Event, Lock, connect_tcp, create_memory_object_stream
 from pycrdt import Array, Doc
 
 
@@ -60,6 +60,40 @@ class Websocket:
         return bytes(b)
 
 
+class RecordingWebsocket:
+    def __init__(self, path: str, send_event: Event | None = None):
+        self._path = path
+        self._send_event = send_event
+        self._closed = Event()
+        self.messages: list[bytes] = []
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> bytes:
+        try:
+            message = await self.recv()
+        except Exception:
+            raise StopAsyncIteration()
+        return message
+
+    async def send(self, message: bytes):
+        if self._send_event is not None:
+            await self._send_event.wait()
+        self.messages.append(message)
+
+    async def recv(self) -> bytes:
+        await self._closed.wait()
+        raise RuntimeError("Websocket closed")
+
+    def close(self) -> None:
+        self._closed.set()
+
+
 class ClientWebsocket:
     def __init__(self, server_websocket: "ServerWebsocket"):
         self.server_websocket = server_websocket